@@ -23,6 +23,8 @@ export function Typography({ children }: PropsWithChildren) {
             {left: '$$', right: '$$', display: true},
             {left: '$', right: '$', display: false},
           ],
+          // Math pre-rendered by the converter is already typeset
+          ignoredClasses: ['katex'],
           throwOnError: false
         });
       }
@@ -47,7 +47,53 @@ export async function getDocsForSlug(slug: string) {
   }
 }
 
+type ChapterHeading = {
+  level: number;
+  text: string;
+  slug: string;
+  children: ChapterHeading[];
+};
+
+type ChapterMeta = {
+  title: string;
+  headings: ChapterHeading[];
+  figures: { src: string; alt: string; width?: number; height?: number }[];
+  word_count: number;
+  source_hash: string;
+};
+
+export async function getDocsMeta(slug: string) {
+  // Written next to index.mdx by scripts/convert_tex_to_md.py
+  try {
+    const metaPath = getDocsMetaPath(slug);
+    const rawMeta = await fs.readFile(metaPath, "utf-8");
+    return JSON.parse(rawMeta) as ChapterMeta;
+  } catch (err) {
+    return undefined;
+  }
+}
+
 export async function getDocsTocs(slug: string) {
+  const meta = await getDocsMeta(slug);
+  if (meta) {
+    const extractedHeadings: { level: number; text: string; href: string }[] = [];
+    const visit = (headings: ChapterHeading[]) => {
+      for (const heading of headings) {
+        if (heading.level >= 2 && heading.level <= 4) {
+          extractedHeadings.push({
+            level: heading.level,
+            text: heading.text,
+            href: `#${heading.slug}`,
+          });
+        }
+        visit(heading.children);
+      }
+    };
+    visit(meta.headings);
+    return extractedHeadings;
+  }
+
+  // Pages without a meta.json are scanned for headings
   const contentPath = getDocsContentPath(slug);
   const rawMdx = await fs.readFile(contentPath, "utf-8");
   const headingsRegex = /^(#{2,4})\s(.+)$/gm;
@@ -66,6 +112,7 @@ export async function getDocsTocs(slug: string) {
   return extractedHeadings;
 }
 
+// Mirrored by sluggify in scripts/convert_tex_to_md.py; keep the two in sync
 function sluggify(text: string) {
   const slug = text.toLowerCase().replace(/\s+/g, "-");
   return slug.replace(/[^a-z0-9-]/g, "");
@@ -74,3 +121,7 @@ function sluggify(text: string) {
 function getDocsContentPath(slug: string) {
   return path.join(process.cwd(), "/contents/docs/", `${slug}/index.mdx`);
 }
+
+function getDocsMetaPath(slug: string) {
+  return path.join(process.cwd(), "/contents/docs/", `${slug}/meta.json`);
+}
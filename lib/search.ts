@@ -0,0 +1,119 @@
+// Queries the search index scripts/convert_tex_to_md.py writes to public/search.
+// Terms are sharded by prefix, so a query only fetches the shards of its words.
+
+type SearchManifest = {
+  prefix_length: number;
+  chapters: Record<
+    string,
+    { title: string; href: string; sections: [string, string][]; shards: string[] }
+  >;
+};
+
+// term -> chapter -> [section, weight, section, weight, ...]
+type SearchShard = Record<string, Record<string, number[]>>;
+
+export type SearchResult = {
+  title: string;
+  heading: string;
+  href: string;
+  score: number;
+};
+
+const SEARCH_ROOT = "/search";
+
+let manifestRequest: Promise<SearchManifest> | undefined;
+const shardRequests = new Map<string, Promise<SearchShard>>();
+
+// Split like search_terms in convert_tex_to_md.py
+export function searchTerms(text: string) {
+  const terms = text.toLowerCase().match(/[\p{L}\p{N}]+/gu) ?? [];
+  return terms.filter((term) => term.length >= 2 && term.length <= 40);
+}
+
+function shardName(term: string, prefixLength: number) {
+  const prefix = Array.from(term).slice(0, prefixLength).join("");
+  if (/^[\x00-\x7f]*$/.test(prefix)) return prefix;
+  return Array.from(new TextEncoder().encode(prefix))
+    .map((byte) => byte.toString(16).padStart(2, "0"))
+    .join("");
+}
+
+function getManifest() {
+  manifestRequest ??= fetch(`${SEARCH_ROOT}/manifest.json`).then((res) =>
+    res.ok ? res.json() : { prefix_length: 2, chapters: {} }
+  );
+  return manifestRequest;
+}
+
+async function fetchShard(name: string): Promise<SearchShard> {
+  const res = await fetch(`${SEARCH_ROOT}/${name}.json.gz`);
+  if (!res.ok) return {};
+  const bytes = new Uint8Array(await res.arrayBuffer());
+  // Servers that send the shards with Content-Encoding: gzip have already inflated them
+  if (bytes[0] !== 0x1f || bytes[1] !== 0x8b) {
+    return JSON.parse(new TextDecoder().decode(bytes));
+  }
+  const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("gzip"));
+  return await new Response(stream).json();
+}
+
+function getShard(name: string) {
+  let request = shardRequests.get(name);
+  if (!request) {
+    request = fetchShard(name);
+    shardRequests.set(name, request);
+  }
+  return request;
+}
+
+export async function searchDocs(query: string, limit = 20) {
+  const terms = searchTerms(query);
+  if (terms.length === 0) return [];
+  const manifest = await getManifest();
+  const shards = await Promise.all(
+    terms.map((term) => getShard(shardName(term, manifest.prefix_length)))
+  );
+
+  // Every word must occur in a section; the last one may be a prefix of a term
+  let scores: Map<string, number> | undefined;
+  terms.forEach((term, i) => {
+    const termScores = new Map<string, number>();
+    for (const [indexed, chapters] of Object.entries(shards[i])) {
+      const matches =
+        indexed === term || (i === terms.length - 1 && indexed.startsWith(term));
+      if (!matches) continue;
+      for (const [chapter, postings] of Object.entries(chapters)) {
+        for (let j = 0; j < postings.length; j += 2) {
+          const key = `${chapter}\u0000${postings[j]}`;
+          termScores.set(key, (termScores.get(key) ?? 0) + postings[j + 1]);
+        }
+      }
+    }
+    if (scores === undefined) {
+      scores = termScores;
+    } else {
+      const previous: Map<string, number> = scores;
+      scores = new Map();
+      termScores.forEach((score, key) => {
+        const earlier = previous.get(key);
+        if (earlier !== undefined) scores!.set(key, earlier + score);
+      });
+    }
+  });
+
+  const results: SearchResult[] = [];
+  scores?.forEach((score, key) => {
+    const [chapter, section] = key.split("\u0000");
+    const entry = manifest.chapters[chapter];
+    if (!entry) return;
+    const [heading, slug] = entry.sections[Number(section)] ?? ["", ""];
+    results.push({
+      title: entry.title,
+      heading,
+      href: slug ? `${entry.href}#${slug}` : entry.href,
+      score,
+    });
+  });
+  results.sort((a, b) => b.score - a.score);
+  return results.slice(0, limit);
+}
@@ -0,0 +1,335 @@
+"""Benchmark convert_tex_to_md.py on synthetic chapters, optionally against a saved baseline."""
+import os
+import re
+import sys
+import io
+import importlib.util
+import json
+import time
+import types
+import random
+import argparse
+import platform
+import shutil
+import statistics
+import struct
+import subprocess
+import tempfile
+import zlib
+from contextlib import redirect_stdout
+
+# Content mix of a generated chapter; every value can be set from the command line
+DEFAULT_CONFIG = {
+    'chapters': 1,
+    'sections': 20,
+    'paragraphs': 6,            # per section
+    'inline_math': 0.5,         # probability of inline math in a sentence
+    'display_math': 0.3,        # probability of a display equation after a paragraph
+    'tables': 2,                # per section, in the `::: center` style format_center_table expects
+    'code_blocks': 1,           # per section
+    'figures': 1,               # per section
+    'subfigures': 0.3,          # probability of a subfigure grid per section
+    'tikz': 0.5,                # probability of a TikZ diagram per section
+    'seed': 0,
+}
+
+# Pipeline stages as recorded by BuildProfile, in order
+STAGES = ('read', 'scan', 'subfigures', 'tikz', 'pandoc', 'images', 'postprocess', 'write', 'meta')
+
+WORDS = ('gradient', 'descent', 'simulation', 'particle', 'field', 'solver', 'energy', 'loss',
+         'adjoint', 'mesh', 'velocity', 'pressure', 'the', 'a', 'of', 'and', 'with', 'is',
+         'we', 'compute', 'update', 'step', 'system', 'state', 'differentiable', 'physics')
+
+SYMBOLS = ('x', 'y', 'u', 'v', r'\theta', r'\alpha', r'\lambda', r'\phi')
+
+def _sentence(rng, config, section):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(8, 18))]
+    tex = md = ' '.join(words).capitalize()
+    if rng.random() < config['inline_math']:
+        symbol = rng.choice(SYMBOLS)
+        math = f'${symbol}_{{{rng.randint(0, 9)}}}^{{2}} + \\frac{{\\partial {symbol}}}{{\\partial t}}$'
+        tex += ' where ' + math
+        md += ' where ' + math
+    if section > 1 and rng.random() < 0.1:
+        target = rng.randint(1, section - 1)
+        tex += f' (see Section~\\ref{{sec:{target}}})'
+        md += (f' (see Section [\\[sec:{target}\\]](#sec:{target})'
+               f'{{reference-type="ref" reference="sec:{target}"}})')
+    return tex + '.', md + '.'
+
+def _display_math(rng):
+    symbol = rng.choice(SYMBOLS)
+    body = (f'\\begin{{aligned}}\n{symbol}_{{t+1}} &= {symbol}_t - \\eta \\nabla L({symbol}_t) \\\\\n'
+            f'L &= \\sum_{{i=1}}^{{N}} \\left\\| {symbol}_i - \\hat{{{symbol}}}_i \\right\\|^2\n\\end{{aligned}}')
+    return f'\\begin{{equation}}\n{body}\n\\end{{equation}}', f'$${body}$$'
+
+def _table(rng):
+    rows = [(rng.choice(WORDS).capitalize(), f'${rng.choice(SYMBOLS)}^{{{rng.randint(2, 5)}}}$')
+            for _ in range(rng.randint(3, 6))]
+    tex = '\\begin{center}\n\\begin{tabular}{ll}\n'
+    tex += ''.join(f'{name} & {definition} \\\\\n' for name, definition in rows)
+    tex += '\\end{tabular}\n\\end{center}'
+    md = '::: center\n  ---------- ------------\n'
+    md += ''.join(f'  {name}   {definition}\n' for name, definition in rows)
+    md += '  ---------- ------------\n:::'
+    return tex, md
+
+def _code_block(rng):
+    lines = [f'{rng.choice(WORDS)} = {rng.choice(WORDS)}({rng.randint(0, 99)}, {{"k": {rng.randint(0, 9)}}})'
+             for _ in range(rng.randint(4, 12))]
+    code = '\n'.join(lines)
+    return (f'\\begin{{lstlisting}}[language=Python]\n{code}\n\\end{{lstlisting}}',
+            f'``` {{.python language="Python"}}\n{code}\n```')
+
+def _figure(rng, chapter, number):
+    caption = ' '.join(rng.choice(WORDS) for _ in range(6)).capitalize()
+    path = f'figures/part1b/{chapter}/figure{number}.png'
+    tex = (f'\\begin{{figure}}[h]\n\\centering\n\\includegraphics[width = 2.7in]{{{path}}}\n'
+           f'\\caption{{{caption}}}\n\\label{{fig:{number}}}\n\\end{{figure}}')
+    md = f'![{caption}]({path}){{#fig:{number} width="2.7in"}}'
+    return tex, md
+
+def _subfigures(rng, chapter, number):
+    panels = rng.randint(2, 3)
+    tex = '\\begin{figure}[h]\n\\centering\n'
+    md = '<figure>\n'
+    for panel in range(panels):
+        caption = ' '.join(rng.choice(WORDS) for _ in range(3)).capitalize()
+        tex += (f'\\begin{{subfigure}}[b]{{0.45\\textwidth}}\n'
+                f'\\includegraphics[width=\\textwidth]{{figures/part1b/{chapter}/sub{number}_{panel}.png}}\n'
+                f'\\caption{{{caption}}}\n\\end{{subfigure}}\n')
+        md += (f'<figure>\n<p><img src="/figures/{chapter}/sub{number}_{panel}.png" alt="{caption}" /></p>\n'
+               f'<figcaption>{caption}</figcaption>\n</figure>\n')
+    tex += '\\caption{Panels}\n\\end{figure}'
+    md += '<figcaption>Panels</figcaption>\n</figure>'
+    return tex, md
+
+def _tikz(rng, chapter, number):
+    nodes = rng.randint(3, 8)
+    body = ''.join(f'\\node[circle,draw] (n{i}) at ({rng.randint(0, 9)},{rng.randint(0, 9)}) {{$x_{i}$}};\n'
+                   for i in range(nodes))
+    body += ''.join(f'\\draw[->] (n{i}) -- (n{i + 1});\n' for i in range(nodes - 1))
+    md = f'![TikZ diagram](/figures/{chapter}/tikz_{number:016x}.png)'
+    return f'\\begin{{tikzpicture}}\n{body}\\end{{tikzpicture}}', md
+
+def generate_chapter(config, index=0):
+    """Return (chapter name, LaTeX source, pandoc-style markdown) for a synthetic chapter."""
+    rng = random.Random(config['seed'] * 1000 + index)
+    chapter = f'synthetic_{index}'
+    tex = [f'\\chapter{{Synthetic Chapter {index}}}']
+    md = [f'# Synthetic Chapter {index}']
+    figure_number = 0
+    for section in range(1, config['sections'] + 1):
+        title = ' '.join(rng.choice(WORDS) for _ in range(3)).capitalize()
+        tex.append(f'\\section{{{title}}}\\label{{sec:{section}}}')
+        md.append(f'## {title} {{#sec:{section}}}')
+
+        blocks = []
+        for _ in range(config['paragraphs']):
+            sentences = [_sentence(rng, config, section) for _ in range(rng.randint(3, 7))]
+            blocks.append((' '.join(s[0] for s in sentences), ' '.join(s[1] for s in sentences)))
+            if rng.random() < config['display_math']:
+                blocks.append(_display_math(rng))
+        extras = [_table(rng) for _ in range(config['tables'])]
+        extras += [_code_block(rng) for _ in range(config['code_blocks'])]
+        for _ in range(config['figures']):
+            figure_number += 1
+            extras.append(_figure(rng, chapter, figure_number))
+        if rng.random() < config['subfigures']:
+            figure_number += 1
+            extras.append(_subfigures(rng, chapter, figure_number))
+        if rng.random() < config['tikz']:
+            figure_number += 1
+            extras.append(_tikz(rng, chapter, figure_number))
+        for extra in extras:
+            blocks.insert(rng.randint(0, len(blocks)), extra)
+
+        tex.extend(block[0] for block in blocks)
+        md.extend(block[1] for block in blocks)
+    return chapter, '\n\n'.join(tex) + '\n', '\n\n'.join(md) + '\n'
+
+class StubPandoc:
+    """Stands in for pypandoc; returns the markdown generated for the chapter being converted."""
+
+    def __init__(self):
+        self.markdown = ''
+
+    def convert_text(self, source, to, format=None, **kwargs):
+        return self.markdown
+
+def stub_run_subprocess(args, profile=None, check=False):
+    """Stands in for run_subprocess: fakes pdflatex, convert and dvisvgm output files."""
+    program = os.path.basename(args[0])
+    if program == 'pdflatex':
+        tex_file = args[-1]
+        with open(tex_file) as f:
+            pages = f.read().count('\\begin{tikzpicture}')
+        with open(os.path.splitext(tex_file)[0] + '.pdf', 'w') as f:
+            f.write(str(pages))
+    elif program == 'convert' and '-resize' in args:
+        with open(args[-1], 'w') as f:
+            f.write('stub')
+    elif program in ('convert', 'dvisvgm'):
+        pdf_path = next(arg for arg in args if arg.endswith('.pdf'))
+        pattern = args[-1] if program == 'convert' else args[args.index('-o') + 1]
+        with open(pdf_path) as f:
+            pages = int(f.read() or 0)
+        for page in range(1, pages + 1):
+            with open(pattern.replace('%d', str(page)).replace('%p', str(page)), 'w') as f:
+                f.write('stub')
+    if profile:
+        profile.count_subprocess(program)
+    return subprocess.CompletedProcess(args, 0, b'', b'')
+
+def write_png(path, width, height):
+    """Write a blank grayscale PNG; the image stage only reads its header and hash."""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = zlib.compress(b'\0' * (width + 1) * height)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+                + chunk(b'IDAT', rows) + chunk(b'IEND', b''))
+
+def load_converter(stub):
+    """Import convert_tex_to_md with the requested external tools stubbed out."""
+    stub_pandoc = None
+    if stub == 'all':
+        stub_pandoc = StubPandoc()
+        # pypandoc itself may be missing where pandoc is
+        if importlib.util.find_spec('pypandoc') is None:
+            sys.modules['pypandoc'] = types.ModuleType('pypandoc')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import convert_tex_to_md as converter
+    if stub_pandoc:
+        converter.pypandoc = stub_pandoc
+    if stub in ('tikz', 'all'):
+        converter.run_subprocess = stub_run_subprocess
+    return converter, stub_pandoc
+
+def run_benchmark(converter, stub_pandoc, config, repeat, tikz_workers=1, tikz_batch=False):
+    """Convert the generated chapters `repeat` times; return the per-run stage times."""
+    chapters = [generate_chapter(config, index) for index in range(config['chapters'])]
+    runs = []
+    with tempfile.TemporaryDirectory() as root:
+        project_root = converter.PROJECT_ROOT
+        converter.PROJECT_ROOT = root
+        try:
+            tex_files = []
+            for chapter, tex, _ in chapters:
+                tex_file = os.path.join(root, 'chapters', f'{chapter}.tex')
+                os.makedirs(os.path.dirname(tex_file), exist_ok=True)
+                with open(tex_file, 'w') as f:
+                    f.write(tex)
+                tex_files.append(tex_file)
+
+            for _ in range(repeat):
+                times = dict.fromkeys(STAGES + ('total',), 0.0)
+                for (chapter, _, markdown), tex_file in zip(chapters, tex_files):
+                    if stub_pandoc:
+                        stub_pandoc.markdown = markdown
+                    # Render TikZ and encode image variants from scratch on every run
+                    shutil.rmtree(os.path.join(root, 'public'), ignore_errors=True)
+                    for path in set(re.findall(r'figures/[\w/]+/(?!tikz_)\w+\.png', markdown)):
+                        write_png(os.path.join(root, 'public', path), 1400, 1050)
+
+                    profile = converter.BuildProfile(chapter)
+                    start = time.perf_counter()
+                    with redirect_stdout(io.StringIO()) as output:
+                        ok = converter.convert_tex_to_mdx(tex_file, os.path.join(root, 'out', chapter),
+                                                          tikz_workers=tikz_workers, tikz_batch=tikz_batch,
+                                                          profile=profile)
+                    times['total'] += time.perf_counter() - start
+                    if not ok:
+                        raise RuntimeError(f"conversion of {chapter} failed:\n{output.getvalue()}")
+                    for stage, entry in profile.stages.items():
+                        times[stage] = times.get(stage, 0.0) + entry['wall']
+                runs.append(times)
+        finally:
+            converter.PROJECT_ROOT = project_root
+    return runs, sum(len(tex) for _, tex, _ in chapters)
+
+def summarize(runs):
+    """Median and minimum of every stage over the runs."""
+    return {stage: {'median': statistics.median(run[stage] for run in runs),
+                    'min': min(run[stage] for run in runs)}
+            for stage in runs[0]}
+
+def print_results(summary, baseline=None, tolerance=0.1):
+    """Print the stage times, next to the baseline if there is one; return the regressed stages."""
+    regressions = []
+    if baseline:
+        print(f"{'stage':<12} {'median':>10} {'min':>10} {'baseline':>10} {'change':>8}")
+    else:
+        print(f"{'stage':<12} {'median':>10} {'min':>10}")
+    for stage, stats in summary.items():
+        line = f"{stage:<12} {stats['median'] * 1000:>8.2f}ms {stats['min'] * 1000:>8.2f}ms"
+        if baseline and stage in baseline['stages']:
+            before = baseline['stages'][stage]['median']
+            change = (stats['median'] - before) / before if before else 0.0
+            line += f" {before * 1000:>8.2f}ms {change:>+7.1%}"
+            # Ignore sub-millisecond stages, whose times are mostly noise
+            if change > tolerance and stats['median'] - before > 0.001:
+                line += "  REGRESSION"
+                regressions.append(stage)
+        print(line)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the LaTeX to MDX converter on synthetic chapters.")
+    for key, value in DEFAULT_CONFIG.items():
+        parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=value,
+                            help=f"(default: {value})")
+    parser.add_argument('--repeat', type=int, default=5, help="number of timed runs (default: 5)")
+    parser.add_argument('--stub', choices=['none', 'tikz', 'all'], default='none',
+                        help="replace the TikZ tools, or the TikZ tools and pandoc, with stubs")
+    parser.add_argument('--tikz-jobs', type=int, default=1, help="TikZ rendering threads")
+    parser.add_argument('--tikz-batch', action='store_true', help="render TikZ in batches")
+    parser.add_argument('--baseline', metavar='FILE', help="compare against a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="slowdown against the baseline reported as a regression (default: 0.1)")
+    parser.add_argument('--save-baseline', metavar='FILE', help="save the results as a baseline")
+    parser.add_argument('--json', metavar='FILE', help="write the raw run times as JSON")
+    args = parser.parse_args(argv)
+
+    config = {key: getattr(args, key) for key in DEFAULT_CONFIG}
+    converter, stub_pandoc = load_converter(args.stub)
+
+    runs, source_bytes = run_benchmark(converter, stub_pandoc, config, args.repeat,
+                                       args.tikz_jobs, args.tikz_batch)
+    summary = summarize(runs)
+    result = {
+        'config': config,
+        'stub': args.stub,
+        'repeat': args.repeat,
+        'source_bytes': source_bytes,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'stages': summary,
+    }
+    print(f"{config['chapters']} chapter(s), {source_bytes} bytes of LaTeX, {args.repeat} runs, stub: {args.stub}")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['config'] != config or baseline['stub'] != args.stub:
+            print("Warning: the baseline was recorded with different settings")
+
+    regressions = print_results(summary, baseline, args.tolerance)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(result, runs=runs), f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if regressions:
+        print(f"Slower than the baseline: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
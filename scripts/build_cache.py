@@ -0,0 +1,161 @@
+"""Persistent on-disk caches shared by the converter's build steps."""
+import glob
+import hashlib
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+# Default locations of the caches
+TIKZ_CACHE_DIR = os.path.join(PROJECT_ROOT, '.cache', 'tikz')
+IMAGE_CACHE_DIR = os.path.join(PROJECT_ROOT, '.cache', 'images')
+SECTION_CACHE_DIR = os.path.join(PROJECT_ROOT, '.cache', 'sections')
+MATH_CACHE_DIR = os.path.join(PROJECT_ROOT, '.cache', 'math')
+
+@contextmanager
+def atomic_path(path, suffix=''):
+    """Yield a temporary path that replaces `path` only if the block completes."""
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp{suffix}'
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """Open a file that replaces `path` only if the block completes."""
+    with atomic_path(path) as temp_path:
+        with open(temp_path, mode) as f:
+            yield f
+
+def file_hash(path):
+    """SHA-256 of a file's contents, or None if it does not exist."""
+    if not os.path.isfile(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class DiskCache:
+    """Content-addressed files or text on disk, evicting least recently used entries."""
+    name = 'Disk'
+    ext = 'txt'
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path_for(self, key, ext='png'):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.{ext}')
+
+    def lookup(self, key, ext='png', seed=None):
+        """Return the cached file for a key, filling it from `seed` if that exists, or None."""
+        path = self.path_for(key, ext)
+        if os.path.exists(path):
+            # Touch the entry so pruning evicts the least recently used ones first
+            os.utime(path)
+            self.hits += 1
+            return path
+        if seed and os.path.exists(seed):
+            self.hits += 1
+            return self.store(key, seed, ext)
+        self.misses += 1
+        return None
+
+    def store(self, key, source_path, ext='png'):
+        """Copy a freshly made file into the cache."""
+        path = self.path_for(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_path(path) as temp_path:
+            shutil.copyfile(source_path, temp_path)
+        if self.max_bytes is not None:
+            self.prune(self.max_bytes)
+        return path
+
+    def read(self, key):
+        """Return the cached text for a key, or None on a miss."""
+        path = self.path_for(key, self.ext)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        with open(path) as f:
+            return f.read()
+
+    def write(self, key, text):
+        path = self.path_for(key, self.ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path) as f:
+            f.write(text)
+        if self.max_bytes is not None:
+            self.prune(self.max_bytes)
+
+    def entries(self):
+        """List (path, size, mtime) for every cached entry."""
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*', '*')):
+            if '.tmp' in os.path.basename(path):
+                continue
+            stat = os.stat(path)
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def prune(self, max_bytes=0):
+        """Evict least recently used entries until the cache fits in max_bytes."""
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        removed, reclaimed = 0, 0
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+            reclaimed += size
+        return removed, reclaimed
+
+    def counts(self):
+        return self.hits, self.misses
+
+    def report(self, since=(0, 0)):
+        """Hits and misses, counted from an earlier counts() if given."""
+        return f"{self.name} cache: {self.hits - since[0]} hits, {self.misses - since[1]} misses"
+
+class TikzRenderCache(DiskCache):
+    """Rendered TikZ diagrams keyed by content hash."""
+    name = 'TikZ'
+
+    def __init__(self, cache_dir=TIKZ_CACHE_DIR, max_bytes=None):
+        super().__init__(cache_dir, max_bytes)
+
+class ImageVariantCache(DiskCache):
+    """Responsive image variants keyed by source hash, settings and width."""
+    name = 'Image'
+
+    def __init__(self, cache_dir=IMAGE_CACHE_DIR, max_bytes=None):
+        super().__init__(cache_dir, max_bytes)
+
+class SectionCache(DiskCache):
+    """Pandoc's markdown for single sections, keyed by content hash."""
+    name = 'Section'
+    ext = 'md'
+
+    def __init__(self, cache_dir=SECTION_CACHE_DIR, max_bytes=None):
+        super().__init__(cache_dir, max_bytes)
+
+class MathRenderCache(DiskCache):
+    """KaTeX markup keyed by the TeX string and display mode."""
+    name = 'Math'
+    ext = 'html'
+
+    def __init__(self, cache_dir=MATH_CACHE_DIR, max_bytes=None):
+        super().__init__(cache_dir, max_bytes)
@@ -0,0 +1,101 @@
+"""Wait for files to be written under a set of directories."""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# inotify event flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+
+class ChangeWatcher:
+    """Report files written under directories, through libc's inotify on Linux or by polling elsewhere."""
+
+    def __init__(self, directories, interval=0.25):
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self.interval = interval
+        self._libc = None
+        self._fd = None
+        self._watches = {}
+        libc_name = ctypes.util.find_library('c')
+        if sys.platform.startswith('linux') and libc_name:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            if fd >= 0:
+                self._libc, self._fd = libc, fd
+        if self._fd is not None:
+            for directory in self.directories:
+                self._watch_tree(directory)
+        else:
+            self._snapshot = self._scan()
+
+    def _watch_tree(self, top):
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        for directory, _, _ in os.walk(top):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), mask)
+            if wd >= 0:
+                self._watches[wd] = directory
+
+    def _scan(self):
+        snapshot = {}
+        for top in self.directories:
+            for directory, _, names in os.walk(top):
+                for name in names:
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def _read_events(self, timeout):
+        """Paths changed within `timeout` seconds (None waits indefinitely)."""
+        changed = set()
+        if self._fd is None:
+            time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+            snapshot = self._scan()
+            changed = set(path for path, stamp in snapshot.items() if self._snapshot.get(path) != stamp)
+            self._snapshot = snapshot
+            return changed
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self._fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost; report every watched directory
+                changed.update(self.directories)
+                continue
+            path = os.path.join(self._watches.get(wd, ''), os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changed.add(path)
+        return changed
+
+    def wait(self, settle=0.05):
+        """Block until files change and return their paths, once no more arrive for `settle` seconds."""
+        changed = set()
+        while not changed:
+            changed = self._read_events(None)
+        while True:
+            more = self._read_events(settle)
+            if not more:
+                return changed
+            changed |= more
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -7,81 +7,47 @@ import glob
 from pathlib import Path
 import subprocess
 import tempfile
-import uuid
+import hashlib
+import json
+import argparse
+import atexit
+import html
+import bisect
+import struct
+import time
+import traceback
+import threading
+import cProfile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-def escape_braces(content):
-    """Escape curly braces in math environments."""
-    content = re.sub(r'(?<!\\)\{', '\\{', content)
-    content = re.sub(r'(?<!\\)\}', '\\}', content)
-    return content
+from build_cache import (PROJECT_ROOT, TIKZ_CACHE_DIR, IMAGE_CACHE_DIR, SECTION_CACHE_DIR, MATH_CACHE_DIR,
+                         atomic_path, atomic_write, file_hash, TikzRenderCache, ImageVariantCache,
+                         SectionCache, MathRenderCache)
+from change_watcher import ChangeWatcher
+from mdx_text import (META_NAME, _CODE_SPAN_RE, _TABLE_SPAN_RE, _FENCED_DIV_RE, _IMAGE_REFERENCE_RE,
+                      _MATH_SPAN_RE, _PRERENDERED_MATH_RE, _plain_math, mdx_sections, sluggify, tokenize_markdown)
+from search_index import SEARCH_INDEX_DIR, SearchIndex
+from tex_scanner import scan_tex, splice_spans
 
-def remove_language_references(content):
-    """Remove language references in code blocks."""
-    return re.sub(r'``` \{\.([a-zA-Z]+)\s+language="[^"]+"\}', '```', content)
-
-def clean_code_blocks(content):
-    """Clean up code block formatting."""
-    def clean_block(match):
-        code = match.group(1).strip()
-
-        code = re.sub(r'\{\.([a-zA-Z]+)\s+language="[^"]+"\}', '', code)
-        return f'```\n{code}\n```'
+def format_center_table(table_content):
+    """Format the body of a `::: center` block as a Property/Definition table."""
+    lines = [line.strip() for line in table_content.split('\n') if line.strip()]
     
-    return re.sub(r'```([\s\S]*?)```', clean_block, content)
-
-def fix_math_delimiters(content):
-    """Convert \( \) to $ $ for inline math and ensure proper display math formatting."""
-    content = re.sub(r'\\\((.*?)\\\)', r'$\1$', content)
+    formatted_lines = []
+    for line in lines:
+        if '----' in line:
+            continue
+        parts = line.split('$', 2)
+        if len(parts) >= 2:
+            property_name = parts[0].strip()
+            definition = '$' + '$'.join(parts[1:])
+            formatted_lines.append(f'| {property_name} | {definition} |')
     
-    return content
-
-def fix_set_notation(content):
-    """Fix set notation formatting."""
-    content = re.sub(r'\\\\{\\\\}', '\\{\\}', content)
-    content = re.sub(r'\\\\{([^}]*)\\\\}', '\\{\\1\\}', content)
-    return content
-
-def format_tables(content):
-    """Format tables in the desired style."""
-    def format_table(match):
-        table_content = match.group(1)
-        
-        lines = [line.strip() for line in table_content.split('\n') if line.strip()]
-        
-        table_content = '\n'.join(lines)
-        table_content = re.sub(r'\{\}', '&#123;&#125;', table_content)
-        
-        formatted_lines = []
-        for line in lines:
-            if '----' in line:
-                continue
-            parts = line.split('$', 2)
-            if len(parts) >= 2:
-                property_name = parts[0].strip()
-                definition = '$' + '$'.join(parts[1:])
-                formatted_lines.append(f'| {property_name} | {definition} |')
-        
-        table = "| Property | Definition |\n|-------------|---------------|\n"
-        table += '\n'.join(formatted_lines)
-        
-        return table
+    table = "| Property | Definition |\n|-------------|---------------|\n"
+    table += '\n'.join(formatted_lines)
     
-    content = re.sub(r'::: center\n(.*?)\n:::', format_table, content, flags=re.DOTALL)
-    return content
-
-def remove_labels(content):
-    """Remove LaTeX label tags and references."""
-    content = re.sub(r'\\label\{[^}]*\}', '', content)
-    content = re.sub(r'\{#[^}]*\}', '', content)
-    content = re.sub(r'\{reference-type="[^"]*"\s+reference="[^"]*"\}', '', content)
-    content = re.sub(r'\[\[.*?\]\]\(#.*?\)', '', content)
-    content = re.sub(r'#\s+([^\\]+)\\', r'# \1', content)
-    content = re.sub(r'\[\]\s*\n', '\n', content)
-    content = re.sub(r'Table \[\[.*?\]\]', 'Table', content)
-    content = re.sub(r'\(#.*?\)', '', content)
-    content = re.sub(r'\[\[.*?\]\]', '', content)
-    content = re.sub(r'\n\s*\n\s*\n', '\n\n', content)
-    return content
+    return table
 
 def extract_title(tex_content):
     """Extract title from LaTeX content."""
@@ -89,384 +55,1894 @@ def extract_title(tex_content):
     title_match = re.search(r'\\title\{([^}]*)\}', tex_content)
     return chapter_match.group(1) if chapter_match else (title_match.group(1) if title_match else "Untitled")
 
-def extract_and_render_tikz(content, tex_file_path, output_dir):
-    """Extract TikZ diagrams from the LaTeX source and render them as images."""
-    # Get the chapter name for organizing TikZ images in public directory
-    chapter_name = os.path.splitext(os.path.basename(tex_file_path))[0]
-    
-    project_root = os.path.abspath(os.path.join(os.path.dirname(os.path.dirname(__file__))))
-    public_figures_dir = os.path.join(project_root, 'public', 'figures', chapter_name)
-    
-    # Create directory if it doesn't exist
-    if not os.path.exists(public_figures_dir):
-        os.makedirs(public_figures_dir)
-    
-    # Get the directory of the tex file for includes
-    tex_dir = os.path.dirname(os.path.abspath(tex_file_path))
-    
-    # Find all TikZ picture environments
-    tikz_pattern = r'\\begin\{tikzpicture\}(.*?)\\end\{tikzpicture\}'
-    tikz_matches = re.finditer(tikz_pattern, content, re.DOTALL)
-    
-    # Template for standalone LaTeX document with TikZ
-    tikz_template = r"""\documentclass[tikz,border=3mm]{standalone}
+def _children_cpu():
+    """CPU time of all subprocesses waited for so far."""
+    times = os.times()
+    return times.children_user + times.children_system
+
+class BuildProfile:
+    """Thread-safe stage timings, sizes and subprocess counts of one chapter conversion."""
+
+    def __init__(self, chapter=''):
+        self.chapter = chapter
+        self.stages = {}
+        self.sizes = {}
+        self.subprocesses = {}
+        self.diagrams = []
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        child_cpu = _children_cpu()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'subprocess_cpu': 0.0})
+            entry['wall'] += time.perf_counter() - wall
+            entry['cpu'] += time.process_time() - cpu
+            entry['subprocess_cpu'] += _children_cpu() - child_cpu
+
+    def count_subprocess(self, program, cpu=0.0):
+        with self._lock:
+            self.subprocesses[program] = self.subprocesses.get(program, 0) + 1
+        self._local.cpu = self.thread_subprocess_cpu() + cpu
+
+    def thread_subprocess_cpu(self):
+        """CPU time of the subprocesses run so far from the calling thread."""
+        return getattr(self._local, 'cpu', 0.0)
+
+    def record_diagram(self, key, status, wall=0.0, cpu=0.0, path=None):
+        """Record one TikZ diagram: cached, rendered, batched or failed."""
+        size = os.path.getsize(path) if path and os.path.exists(path) else 0
+        with self._lock:
+            self.diagrams.append({'key': key[:16], 'status': status, 'wall': wall,
+                                  'subprocess_cpu': cpu, 'bytes': size})
+
+    def report(self):
+        """The profile as a JSON-serializable dict."""
+        return {
+            'chapter': self.chapter,
+            'stages': self.stages,
+            'sizes': self.sizes,
+            'subprocesses': self.subprocesses,
+            'diagrams': self.diagrams,
+            'counters': self.counters,
+        }
+
+def run_subprocess(args, profile=None, check=False):
+    """Run a command with its output captured, like subprocess.run, counting its CPU time in `profile`."""
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(args, stdout=stdout, stderr=stderr)
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        stdout.seek(0)
+        stderr.seek(0)
+        result = subprocess.CompletedProcess(args, process.returncode, stdout.read(), stderr.read())
+    if profile:
+        profile.count_subprocess(os.path.basename(args[0]), usage.ru_utime + usage.ru_stime)
+    if check:
+        result.check_returncode()
+    return result
+
+# Preamble of the standalone LaTeX document used to render TikZ
+TIKZ_PREAMBLE = r"""\documentclass[tikz,border=3mm]{standalone}
 \usepackage{tikz}
 \usetikzlibrary{arrows,shapes,positioning,calc,decorations.pathreplacing,decorations.pathmorphing,decorations.markings}
 %ADDITIONAL_PACKAGES%
-\begin{document}
+"""
+
+# Template for standalone LaTeX document with TikZ
+TIKZ_TEMPLATE = TIKZ_PREAMBLE + r"""\begin{document}
 \begin{tikzpicture}
 %TIKZ_CONTENT%
 \end{tikzpicture}
 \end{document}
 """
-    
-    # Process each TikZ diagram
-    for i, match in enumerate(tikz_matches):
-        tikz_content = match.group(1)
-        
-        # Create a unique name for the output file
-        unique_id = str(uuid.uuid4())[:8]
-        output_filename = f"tikz_{i}_{unique_id}.png"
-        output_path = os.path.join(public_figures_dir, output_filename)
-        
+
+# Rasterization settings used when converting the compiled PDF to PNG
+TIKZ_RENDER_SETTINGS = {'density': 300, 'quality': 90}
+
+# Vector output through dvisvgm; fonts are either converted to paths or embedded as WOFF2
+TIKZ_SVG_SETTINGS = {'format': 'svg', 'fonts': 'paths'}
+
+# Fewest diagrams compiled as one document with --tikz-batch; a chapter only
+# gets another document per worker once each has this many
+TIKZ_BATCH_MIN = 8
+
+def tikz_cache_key(tikz_content, packages, settings):
+    """Hash everything that influences a rendered TikZ image."""
+    digest = hashlib.sha256()
+    for part in (TIKZ_TEMPLATE, packages, tikz_content, json.dumps(settings, sort_keys=True)):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def extract_tikz_packages(content):
+    """Collect the \\usepackage lines of the source for the standalone preamble."""
+    packages = re.findall(r'\\usepackage(\[.*?\])?\{(.*?)\}', content)
+    return "\n".join([f"\\usepackage{opt}{{{pkg}}}" for opt, pkg in packages])
+
+def convert_tikz_pdf(pdf_path, settings=TIKZ_RENDER_SETTINGS, profile=None):
+    """Convert every page of a compiled TikZ PDF to PNG or SVG and return the page images in order."""
+    temp_dir = os.path.dirname(pdf_path)
+    if settings.get('format', 'png') == 'svg':
+        font_options = ['--no-fonts'] if settings.get('fonts') == 'paths' else ['--font-format=woff2']
+        run_subprocess(['dvisvgm', '--pdf', '--page=1-', *font_options,
+                        '-o', os.path.join(temp_dir, 'page-%p.svg'), pdf_path],
+                       profile, check=True)
+        ext = 'svg'
+    else:
+        run_subprocess(['convert', '-density', str(settings['density']), pdf_path,
+                        '-quality', str(settings['quality']), '-scene', '1',
+                        os.path.join(temp_dir, 'page-%d.png')],
+                       profile, check=True)
+        ext = 'png'
+    pages = glob.glob(os.path.join(temp_dir, f'page-*.{ext}'))
+    return sorted(pages, key=lambda page: int(re.search(r'page-(\d+)\.', page).group(1)))
+
+def render_tikz(tikz_content, packages, output_path, settings=TIKZ_RENDER_SETTINGS, profile=None):
+    """Compile a single TikZ picture with pdflatex and convert it to output_path."""
+    # Create a temporary directory for LaTeX compilation
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Prepare the standalone LaTeX file with the TikZ content
+        tikz_document = TIKZ_TEMPLATE.replace('%TIKZ_CONTENT%', tikz_content)
+        tikz_document = tikz_document.replace('%ADDITIONAL_PACKAGES%', packages)
+
+        # Write the temporary LaTeX file
+        temp_tex_file = os.path.join(temp_dir, 'tikz_temp.tex')
+        with open(temp_tex_file, 'w') as f:
+            f.write(tikz_document)
+
+        # Compile with pdflatex
+        run_subprocess(['pdflatex', '-interaction=nonstopmode', '-output-directory', temp_dir, temp_tex_file],
+                       profile, check=True)
+
+        # Convert the PDF to the requested image format
+        pdf_path = os.path.join(temp_dir, 'tikz_temp.pdf')
+        if not os.path.exists(pdf_path):
+            raise Exception("PDF output not generated")
+        pages = convert_tikz_pdf(pdf_path, settings, profile)
+        if not pages:
+            raise Exception("No image generated from PDF")
+        shutil.move(pages[0], output_path)
+
+def render_tikz_batch(jobs, packages, settings=TIKZ_RENDER_SETTINGS, profile=None):
+    """Render TikZ jobs as pages of one document; returns the jobs left for rendering one by one."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Build the document, remembering which lines belong to which diagram
+        lines = TIKZ_PREAMBLE.replace('%ADDITIONAL_PACKAGES%', packages).split('\n')
+        lines.append('\\begin{document}')
+        spans = []
+        for tikz_content, _ in jobs:
+            first_line = len(lines) + 1
+            lines.extend(['\\begin{tikzpicture}'] + tikz_content.split('\n') + ['\\end{tikzpicture}'])
+            spans.append((first_line, len(lines)))
+        lines.append('\\end{document}')
+
+        temp_tex_file = os.path.join(temp_dir, 'tikz_batch.tex')
+        with open(temp_tex_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        # Compile once; errors are located through the file:line prefixes in the log
+        result = run_subprocess(['pdflatex', '-interaction=nonstopmode', '-file-line-error',
+                                 '-output-directory', temp_dir, temp_tex_file], profile)
+        pdf_path = os.path.join(temp_dir, 'tikz_batch.pdf')
+        if result.returncode != 0 or not os.path.exists(pdf_path):
+            log_path = os.path.join(temp_dir, 'tikz_batch.log')
+            log = ''
+            if os.path.exists(log_path):
+                with open(log_path, errors='replace') as f:
+                    log = f.read()
+            error_lines = [int(n) for n in re.findall(r'^.*tikz_batch\.tex:(\d+):', log, re.MULTILINE)]
+            offending = [i for i, (first, last) in enumerate(spans)
+                         if any(first <= n <= last for n in error_lines)]
+            if not offending:
+                # The failure cannot be attributed to a diagram, retry them all
+                return list(jobs)
+            remaining = [job for i, job in enumerate(jobs) if i not in offending]
+            failed = [jobs[i] for i in offending]
+            if remaining:
+                failed += render_tikz_batch(remaining, packages, settings, profile)
+            return failed
+
+        # Convert every page in a single converter call
+        pages = convert_tikz_pdf(pdf_path, settings, profile)
+        if len(pages) != len(jobs):
+            # Page count does not line up with the diagrams, so none can be trusted
+            return list(jobs)
+        for page, (_, output_path) in zip(pages, jobs):
+            shutil.move(page, output_path)
+    return []
+
+# Directory under public/figures holding the images the converter makes
+# (TikZ renders and image variants), shared by every chapter
+FIGURE_STORE = 'shared'
+
+def _copy_file(source, target):
+    with atomic_path(target) as temp_path:
+        shutil.copyfile(source, temp_path)
+
+def store_figure(path, name):
+    """Copy a rendered image into the figure store under name, unless unchanged, and return its URL."""
+    store_dir = os.path.join(PROJECT_ROOT, 'public', 'figures', FIGURE_STORE)
+    target = os.path.join(store_dir, name)
+    if file_hash(target) != file_hash(path):
+        os.makedirs(store_dir, exist_ok=True)
+        _copy_file(path, target)
+    return f'/figures/{FIGURE_STORE}/{name}'
+
+# Stands in for the code of a diagram that failed to render until pandoc is done
+_TIKZ_PLACEHOLDER_RE = re.compile(r'^([ \t]*)TIKZCODE(\d+)X$', re.MULTILINE)
+
+def restore_tikz_code(mdx_content, fallbacks):
+    """Swap the placeholders extract_and_render_tikz left in for code blocks of the diagrams."""
+    def code_block(match):
+        indent, code = match.group(1), fallbacks[int(match.group(2))]
+        fence = '`' * max([3] + [len(run) + 1 for run in re.findall(r'`+', code)])
+        return '\n'.join(indent + line if line else line for line in [fence, *code.split('\n'), fence])
+    return _TIKZ_PLACEHOLDER_RE.sub(code_block, mdx_content)
+
+def extract_and_render_tikz(content, chapter_name, cache=None, workers=1, batch=False,
+                            settings=TIKZ_RENDER_SETTINGS, index=None, profile=None, warn=print,
+                            fallbacks=None):
+    """Render the TikZ diagrams of the LaTeX source into the figure store and replace them with images."""
+    # Find all TikZ picture environments; a nested one is part of its parent
+    if index is None:
+        index = scan_tex(content)
+    tikz_spans = index.find('tikzpicture', outermost=True)
+    if not tikz_spans:
+        return content
+    with tempfile.TemporaryDirectory() as render_dir:
+        return _render_tikz_spans(content, tikz_spans, render_dir, cache, workers, batch, settings,
+                                  profile, warn, fallbacks)
+
+def _render_tikz_spans(content, tikz_spans, render_dir, cache, workers, batch, settings, profile, warn,
+                       fallbacks):
+    # The rest of extract_and_render_tikz; renders land in render_dir until stored
+
+    # The preamble is shared by every diagram in the chapter
+    packages = extract_tikz_packages(content)
+    ext = settings.get('format', 'png')
+
+    # Resolve cache hits up front and collect the distinct diagrams left to render
+    keys = []
+    pending = {}
+    urls = {}
+    for span in tikz_spans:
+        tikz_content = span.body
+        key = tikz_cache_key(tikz_content, packages, settings)
+        keys.append(key)
+        if key in pending:
+            continue
+
+        cached_path = cache.lookup(key, ext) if cache else None
+        if cached_path:
+            urls[key] = store_figure(cached_path, f"tikz_{key[:16]}.{ext}")
+            pending[key] = None
+            if profile:
+                profile.record_diagram(key, 'cached', path=cached_path)
+        else:
+            pending[key] = (tikz_content, os.path.join(render_dir, f"tikz_{key[:16]}.{ext}"))
+
+    def render(key):
+        tikz_content, output_path = pending[key]
+        start = time.perf_counter()
+        cpu = profile.thread_subprocess_cpu() if profile else 0.0
+        status = 'failed'
         try:
-            # Create a temporary directory for LaTeX compilation
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Prepare the standalone LaTeX file with the TikZ content
-                tikz_document = tikz_template.replace('%TIKZ_CONTENT%', tikz_content)
-                
-                # Try to extract additional packages needed from the original file
-                packages = re.findall(r'\\usepackage(\[.*?\])?\{(.*?)\}', content)
-                additional_packages = "\n".join([f"\\usepackage{opt}{{{pkg}}}" for opt, pkg in packages])
-                tikz_document = tikz_document.replace('%ADDITIONAL_PACKAGES%', additional_packages)
-                
-                # Write the temporary LaTeX file
-                temp_tex_file = os.path.join(temp_dir, 'tikz_temp.tex')
-                with open(temp_tex_file, 'w') as f:
-                    f.write(tikz_document)
-                
-                # Compile with pdflatex
-                subprocess.run(['pdflatex', '-interaction=nonstopmode', '-output-directory', temp_dir, temp_tex_file], 
-                               check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                
-                # Convert PDF to PNG with higher resolution
-                pdf_path = os.path.join(temp_dir, 'tikz_temp.pdf')
-                if os.path.exists(pdf_path):
-                    subprocess.run(['convert', '-density', '300', pdf_path, '-quality', '90', output_path],
-                                  check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                else:
-                    raise Exception("PDF output not generated")
-                
-                # Replace the TikZ environment with an image tag in the content
-                img_tag = f'<img src="/figures/{chapter_name}/{output_filename}" alt="TikZ diagram" />'
-                content = content.replace(match.group(0), img_tag)
-            
+            render_tikz(tikz_content, packages, output_path, settings, profile)
+            status = 'rendered'
+        finally:
+            if profile:
+                profile.record_diagram(key, status, time.perf_counter() - start,
+                                       profile.thread_subprocess_cpu() - cpu, output_path)
+        if cache:
+            cache.store(key, output_path, ext)
+        urls[key] = store_figure(output_path, os.path.basename(output_path))
+
+    def render_chunk(keys):
+        start = time.perf_counter()
+        cpu = profile.thread_subprocess_cpu() if profile else 0.0
+        try:
+            failed = render_tikz_batch([pending[key] for key in keys], packages, settings, profile)
         except Exception as e:
-            print(f"Error rendering TikZ diagram: {e}")
+            warn(f"Error rendering TikZ batch: {e}")
+            return keys
+        failed_keys = [key for key in keys if pending[key] in failed]
+        done = [key for key in keys if key not in failed_keys]
+        for key in done:
+            if cache:
+                cache.store(key, pending[key][1], ext)
+            urls[key] = store_figure(pending[key][1], os.path.basename(pending[key][1]))
+        if profile and done:
+            # A batch's time is shared evenly among the diagrams it rendered
+            wall = (time.perf_counter() - start) / len(done)
+            cpu = (profile.thread_subprocess_cpu() - cpu) / len(done)
+            for key in done:
+                profile.record_diagram(key, 'batched', wall, cpu, pending[key][1])
+        return failed_keys
+
+    to_render = [key for key, job in pending.items() if job]
+
+    # Compile the misses as few documents as the workers allow, keeping only the failures
+    if batch and len(to_render) > 1:
+        chunk_count = max(1, min(workers, len(to_render) // TIKZ_BATCH_MIN))
+        chunks = [to_render[i::chunk_count] for i in range(chunk_count)]
+        with ThreadPoolExecutor(max_workers=chunk_count) as executor:
+            failed_keys = set(key for failed in executor.map(render_chunk, chunks) for key in failed)
+        to_render = [key for key in to_render if key in failed_keys]
+
+    # Render the rest concurrently; each worker mostly waits on a subprocess
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {key: executor.submit(render, key) for key in to_render}
+        for key in to_render:
+            try:
+                futures[key].result()
+            except Exception as e:
+                errors[key] = e
+
+    # Splice the image tags back in a single pass over the source
+    replacements = []
+    for span, key in zip(tikz_spans, keys):
+        if key in errors:
+            warn(f"Error rendering TikZ diagram: {errors[key]}")
             # Keep the original TikZ code as a code block
-            content = content.replace(match.group(0), f"```\n{match.group(0)}\n```")
-    
-    return content
-
-def handle_images(content, tex_file_path, output_dir):
-    """Process LaTeX image references and copy images to output directory."""
-    # Instead of creating a new images directory, use the public/figures path
-    # The images should already be in public/figures
-    # Get the directory of the tex file
-    tex_dir = os.path.dirname(os.path.abspath(tex_file_path))
-    
-    # Get the chapter name from the tex file
-    chapter_name = os.path.splitext(os.path.basename(tex_file_path))[0]
-    
-    # Handle includegraphics commands
-    def process_image(match):
-        options = match.group(2) if match.group(2) else ""
-        image_path = match.group(3)
-        after_content = match.group(4) if len(match.groups()) > 3 and match.group(4) else ""
-        
-        # Remove file extension if present, as LaTeX allows specifying images without extensions
-        image_basename = os.path.splitext(image_path)[0]
-        
-        # Extract width if specified in options - but don't convert to style
-        width_attr = ""
-        width_match = re.search(r'width=([^,\]]+)', options)
-        if width_match:
-            # Don't convert to CSS, leave the width attribute to be handled by MDX renderer
-            pass
-        
-        # Use the Next.js public directory URL structure
-        # Ensure the path starts with a forward slash
-        relative_path = f'/figures/{chapter_name}/{os.path.basename(image_basename)}.png'
-        
-        # Extract caption if present
-        caption_match = re.search(r'\\caption\{([^}]*)\}', after_content)
-        caption = caption_match.group(1) if caption_match else ""
-        
-        if caption:
-            return f'<figure>\n  <img src="{relative_path}" alt="{caption}" />\n  <figcaption>{caption}</figcaption>\n</figure>'
+            if fallbacks is None:
+                replacement = f"```\n{span.text}\n```"
+            else:
+                replacement = f"\n\nTIKZCODE{len(fallbacks)}X\n\n"
+                fallbacks.append(span.text)
         else:
-            return f'<img src="{relative_path}" alt="Figure" />'
-    
-    # Handle \includegraphics commands
-    content = re.sub(r'\\includegraphics(\[([^\]]*)\])?\{([^}]*)\}(.*?)(?=\\|$)', process_image, content)
-    
-    # Handle figure environments
-    def process_figure(match):
-        figure_content = match.group(1)
-        
-        # Extract the includegraphics command
-        img_match = re.search(r'\\includegraphics(\[([^\]]*)\])?\{([^}]*)\}(.*?)(?=\\|$)', figure_content)
-        if img_match:
-            options = img_match.group(2) if img_match.group(2) else ""
-            image_path = img_match.group(3)
-            
-            # Extract caption if present
-            caption_match = re.search(r'\\caption\{([^}]*)\}', figure_content)
-            caption = caption_match.group(1) if caption_match else ""
-            
-            # Process the image in the same way as above
-            result = process_image(img_match)
-            
-            # If there was no caption in the includegraphics match but there is one in the figure environment
-            if caption and '<figcaption>' not in result:
-                if '<figure>' in result:
-                    # Replace the existing figcaption
-                    result = re.sub(r'<figcaption>.*?</figcaption>', f'<figcaption>{caption}</figcaption>', result)
+            # Replace the TikZ environment with an image pandoc passes on to the image stage
+            replacement = f'\\includegraphics[alt={{TikZ diagram}}]{{{urls[key]}}}'
+        replacements.append((span.start, span.end, replacement))
+
+    return splice_spans(content, replacements)
+
+def _plain_tex(tex):
+    """Plain text of a short LaTeX fragment, such as a caption, for alt text."""
+    text = re.sub(r'(?<!\\)%[^\n]*', '', tex)
+    text = re.sub(r'\\(?:label|ref|eqref|cite[a-z]*)\s*\{[^}]*\}', '', text)
+    text = text.replace('\\\\', ' ').replace('\\%', ' percent').replace('~', ' ')
+    # Command names go; the text of their arguments stays
+    text = re.sub(r'\\[a-zA-Z@]+\*?', ' ', text)
+    text = re.sub(r'\\(.)', r'\1', text)
+    text = re.sub(r'[{}$]', '', text)
+    return ' '.join(text.split())
+
+def handle_subfigures(content, chapter_name, index=None):
+    """Point the images of LaTeX subfigures at /figures/<chapter>/, with their subcaptions as alt text."""
+    if index is None:
+        index = scan_tex(content)
+
+    replacements = []
+    for subfig in index.find('subfigure'):
+        graphic = subfig.first('includegraphics')
+        if graphic is None:
+            continue
+        subcaption_span = subfig.first('caption')
+        subcaption = _plain_tex(subcaption_span.body) if subcaption_span else ""
+
+        public_path, _ = _image_file(f'/figures/{chapter_name}/{os.path.basename(graphic.body.strip())}')
+        options = f'alt={{{subcaption}}}' + (f',{graphic.options}' if graphic.options else '')
+        replacements.append((graphic.start, graphic.end, f'\\includegraphics[{options}]{{{public_path}}}'))
+
+    return splice_spans(content, replacements)
+
+# Widths of the variants made for every raster figure, and the encoder quality per format
+IMAGE_VARIANT_SETTINGS = {'widths': [320, 640, 960, 1280, 1920], 'formats': {'avif': 50, 'webp': 80}}
+
+# CSS pixels per unit of the lengths pandoc keeps from \includegraphics[width=...]
+CSS_PIXELS_PER_UNIT = {'px': 1, 'in': 96, 'cm': 96 / 2.54, 'mm': 96 / 25.4, 'pt': 96 / 72,
+                       'bp': 96 / 72, 'pc': 16}
+
+def image_size(path):
+    """Read the pixel size of a PNG or JPEG from its header; None for other files."""
+    with open(path, 'rb') as f:
+        header = f.read(24)
+        if header.startswith(b'\x89PNG\r\n\x1a\n'):
+            return struct.unpack('>II', header[16:24])
+        if not header.startswith(b'\xff\xd8'):
+            return None
+        # Walk the JPEG segments up to the frame header
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xff:
+                return None
+            if marker[1] == 0xff:
+                f.seek(-1, 1)
+                continue
+            length = struct.unpack('>H', f.read(2))[0]
+            if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack('>xHH', f.read(5))
+                return width, height
+            f.seek(length - 2, 1)
+
+def css_length(value):
+    """Parse a width hint such as 2.7in or 50% into ('px', pixels) or ('%', percent)."""
+    match = re.fullmatch(r'\s*(\d*\.?\d+)\s*(%|[a-z]{2})\s*', value or '')
+    if not match:
+        return None
+    number, unit = float(match.group(1)), match.group(2)
+    if unit == '%':
+        return '%', number
+    if unit in CSS_PIXELS_PER_UNIT:
+        return 'px', number * CSS_PIXELS_PER_UNIT[unit]
+    return None
+
+def picture_markup(url, alt, size, width_hint=None, variants=None):
+    """Build the <picture> element of an image from its variants, {format: [(width, url)]}."""
+    width, height = size
+    length = css_length(width_hint)
+    style = ''
+    if length and length[0] == 'px':
+        shown = max(1, round(length[1]))
+        width, height = shown, max(1, round(shown * height / width))
+        sizes = f'(max-width: {shown}px) 100vw, {shown}px'
+    elif length:
+        sizes = f'{length[1]:g}vw'
+        style = f' style={{{{width: "{length[1]:g}%", height: "auto"}}}}'
+    else:
+        sizes = f'(max-width: {width}px) 100vw, {width}px'
+
+    alt = html.escape(' '.join(alt.split()), quote=True)
+    parts = []
+    for image_format, candidates in (variants or {}).items():
+        if candidates:
+            srcset = ', '.join(f'{candidate} {candidate_width}w' for candidate_width, candidate in candidates)
+            parts.append(f'<source type="image/{image_format}" srcSet="{srcset}" sizes="{sizes}" />')
+    img = (f'<img src="{url}" alt="{alt}" width="{width}" height="{height}"{style} '
+           f'loading="lazy" decoding="async" />')
+    if not parts:
+        return img
+    return f'<picture>{"".join(parts)}{img}</picture>'
+
+def _image_url(path, chapter_name):
+    """The public URL an image ends up at after post-processing, as _fix_figure_path computes it."""
+    url = path if path.startswith('/') else f'/{path}'
+    if chapter_name and not re.match(r'^/figures/[^/]+/', url):
+        url = f'/figures/{chapter_name}/{os.path.basename(url)}'
+    return url
+
+def _image_file(url):
+    """The file under public/ behind an image URL, trying the usual extensions if it has none."""
+    path = os.path.join(PROJECT_ROOT, 'public', url.lstrip('/'))
+    if os.path.splitext(path)[1]:
+        return url, path
+    for ext in ('.png', '.jpg', '.jpeg'):
+        if os.path.isfile(path + ext):
+            return url + ext, path + ext
+    return url, path
+
+def responsive_images(md_content, chapter_name='', cache=None, workers=1,
+                      settings=IMAGE_VARIANT_SETTINGS, profile=None, warn=print):
+    """Replace the raster images in pandoc's markdown with <picture> markup over AVIF and WebP variants."""
+    code_spans = [(match.start(), match.end()) for match in _CODE_SPAN_RE.finditer(md_content)]
+
+    def in_code(position):
+        return any(start <= position < end for start, end in code_spans)
+
+    # Collect the images and the variants they are missing
+    references = []
+    images = {}
+    for match in _IMAGE_REFERENCE_RE.finditer(md_content):
+        if in_code(match.start()):
+            continue
+        if match.group('tag'):
+            src = re.search(r'\bsrc="([^"]+)"', match.group('tag'))
+            alt = re.search(r'\balt="([^"]*)"', match.group('tag'))
+            if not src:
+                continue
+            path, alt_text, hint = src.group(1), html.unescape(alt.group(1)) if alt else '', None
+        else:
+            attrs = match.group('attrs') or ''
+            width = re.search(r'\bwidth="([^"]*)"', attrs)
+            path, alt_text, hint = match.group('path'), match.group('alt'), width.group(1) if width else None
+        if re.match(r'^[a-z]+:', path):
+            continue
+        url, file_path = _image_file(_image_url(path, chapter_name))
+        if file_path not in images:
+            size = image_size(file_path) if os.path.isfile(file_path) else None
+            images[file_path] = {'url': url, 'size': size, 'variants': {}}
+        if images[file_path]['size']:
+            references.append((match, file_path, alt_text, hint))
+
+    # Plan the variants; existing and cached ones are reused
+    jobs = []
+    settings_key = json.dumps(settings, sort_keys=True)
+    store_dir = os.path.join(PROJECT_ROOT, 'public', 'figures', FIGURE_STORE)
+    for file_path, image in images.items():
+        if not image['size']:
+            continue
+        os.makedirs(store_dir, exist_ok=True)
+        key = hashlib.sha256(f'{file_hash(file_path)}\0{settings_key}'.encode('utf-8')).hexdigest()
+        width = image['size'][0]
+        widths = [candidate for candidate in settings['widths'] if candidate < width] + [width]
+        for image_format, quality in settings['formats'].items():
+            for variant_width in widths:
+                name = f'{key[:16]}-{variant_width}.{image_format}'
+                output_path = os.path.join(store_dir, name)
+                variant = (variant_width, f'/figures/{FIGURE_STORE}/{name}')
+                variant_key = f'{key}-{variant_width}'
+                cached_path = cache.lookup(variant_key, image_format, seed=output_path) if cache else None
+                if cached_path and not os.path.exists(output_path):
+                    _copy_file(cached_path, output_path)
+                if cached_path or os.path.exists(output_path):
+                    image['variants'].setdefault(image_format, []).append(variant)
                 else:
-                    # Convert to figure with caption
-                    result = result.replace('<img', '<figure>\n  <img')
-                    result = result.replace('/>', f'/>\n  <figcaption>{caption}</figcaption>\n</figure>')
-            
-            return result
-        return match.group(0)
-    
-    content = re.sub(r'\\begin\{figure\}(.*?)\\end\{figure\}', process_figure, content, flags=re.DOTALL)
-    
-    return content
+                    jobs.append((file_path, output_path, variant_width, image_format, quality,
+                                 variant_key, variant))
 
-def handle_subfigures(content, tex_file_path, output_dir):
-    """Handle LaTeX subfigures by converting them to MDX image grids."""
-    # Get the chapter name for image paths
-    chapter_name = os.path.splitext(os.path.basename(tex_file_path))[0]
-    
-    # Get the directory of the tex file
-    tex_dir = os.path.dirname(os.path.abspath(tex_file_path))
-    
-    def process_subfigure_environment(match):
-        """Process a full subfigure environment and convert to MDX grid."""
-        figure_env = match.group(0)
-        figure_content = match.group(1)
-        
-        # Extract the main figure caption if present
-        main_caption_match = re.search(r'\\caption\{([^}]*)\}', figure_content)
-        main_caption = main_caption_match.group(1) if main_caption_match else ""
-        
-        # Find all subfigures
-        subfigure_pattern = r'\\begin\{subfigure\}(?:\[.*?\])?\{.*?\}(.*?)\\end\{subfigure\}'
-        subfigures = re.finditer(subfigure_pattern, figure_content, re.DOTALL)
-        
-        subfigure_images = []
-        for subfig in subfigures:
-            subfig_content = subfig.group(1)
-            
-            # Extract subfigure caption
-            subcaption_match = re.search(r'\\caption\{([^}]*)\}', subfig_content)
-            subcaption = subcaption_match.group(1) if subcaption_match else ""
-            
-            # Extract image
-            img_match = re.search(r'\\includegraphics(?:\[([^\]]*)\])?\{([^}]*)\}', subfig_content)
-            if img_match:
-                options = img_match.group(1) if img_match.group(1) else ""
-                image_path = img_match.group(2)
-                
-                # Process image to get the path in public directory
-                image_basename = os.path.splitext(image_path)[0]
-                
-                # Create the public URL path - ensure it starts with a slash
-                public_path = f'/figures/{chapter_name}/{os.path.basename(image_basename)}.png'
-                
-                # Add to our list of subfigure images
-                subfigure_images.append({
-                    'path': public_path,
-                    'caption': subcaption
-                })
-        
-        # Create a grid of images based on the number of subfigures
-        if subfigure_images:
-            num_images = len(subfigure_images)
-            
-            # Determine grid layout (auto, or get from figure options if available)
-            columns = min(3, num_images)  # Default to max 3 columns
-            
-            # Create the grid container - without inline styles
-            grid_html = f'<figure className="subfigure-grid">\n'
-            grid_html += f'  <div className="grid-container">\n'
-            
-            # Add each subfigure
-            for img in subfigure_images:
-                if img['path']:
-                    grid_html += f'    <div className="subfigure">\n'
-                    grid_html += f'      <img src="{img["path"]}" alt="{img["caption"]}" />\n'
-                    if img['caption']:
-                        grid_html += f'      <figcaption>{img["caption"]}</figcaption>\n'
-                    grid_html += f'    </div>\n'
+    def encode(job):
+        file_path, output_path, variant_width, image_format, quality, variant_key, _ = job
+        with atomic_path(output_path, f'.{image_format}') as temp_path:
+            run_subprocess(['convert', file_path, '-resize', f'{variant_width}x', '-strip',
+                            '-quality', str(quality), temp_path], profile, check=True)
+        if cache:
+            cache.store(variant_key, output_path, image_format)
+
+    failed_formats = set()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for job, future in [(job, executor.submit(encode, job)) for job in jobs]:
+            try:
+                future.result()
+                images[job[0]]['variants'].setdefault(job[3], []).append(job[6])
+                if profile:
+                    profile.counters['image_variants'] = profile.counters.get('image_variants', 0) + 1
+            except Exception as e:
+                if job[3] not in failed_formats:
+                    warn(f"Error writing {job[3]} image variants: {e}")
+                failed_formats.add(job[3])
+
+    # Splice the markup in, one pass over the markdown
+    replacements = []
+    for match, file_path, alt_text, hint in references:
+        image = images[file_path]
+        variants = {image_format: sorted(image['variants'].get(image_format, []))
+                    for image_format in settings['formats'] if image_format not in failed_formats}
+        replacements.append((match.start(), match.end(),
+                             picture_markup(image['url'], alt_text, image['size'], hint, variants)))
+    return splice_spans(md_content, replacements)
+
+
+def _escape_braces(content):
+    """Escape the curly braces that are not escaped yet, for MDX."""
+    content = content.replace('{', '\\{').replace('}', '\\}')
+    return content.replace('\\\\{', '\\{').replace('\\\\}', '\\}')
+
+def _fix_figure_path(match, chapter_name):
+    alt_text = match.group(1)
+    path = match.group(2)
+    # Missing attributes format as "None"; a later rule strips the
+    # None{width=...} this leaves behind
+    attrs = match.group(3)
+    # Skip if already in correct format
+    if re.match(r'^/figures/[^/]+/', path):
+        return f'![{alt_text}]({path}){attrs}'
+    return f'![{alt_text}](/figures/{chapter_name}/{os.path.basename(path)}){attrs}'
+
+def _fix_part1b_path(match, chapter_name):
+    return f'![{match.group(1)}](/figures/{chapter_name}/{match.group(2)}){match.group(3) if match.group(3) else ""}'
+
+# Rules applied to every span before and after the heading fix-up, in the
+# order the cleanup has always applied them. Each entry is (pattern, replacement, guard,
+# span kinds); the pattern only runs when the guard substring is present
+# and the span is of one of the kinds (None for all kinds). Replacements
+# taking the chapter name are only applied when one is known.
+_PRE_HEADING_RULES = [
+    # Set notation
+    (re.compile(r'\\\\{\\\\}'), '\\{\\}', '\\\\{', None),
+    (re.compile(r'\\\\{([^}]*)\\\\}'), '\\{\\1\\}', '\\\\{', None),
+    # \( \) to $ $
+    (re.compile(r'\\\((.*?)\\\)'), r'$\1$', '\\(', None),
+]
+
+_PRE_HEADING_LABEL_RULES = [
+    # Labels and references, up to the heading fix-up
+    (re.compile(r'\{#[^}]*\}'), '', '{#', None),
+    (re.compile(r'\[\[.*?\]\]\(#.*?\)'), '', '[[', None),
+]
+
+_POST_HEADING_RULES = [
+    # Labels and references, after the heading fix-up
+    (re.compile(r'\[\]\s*\n'), '\n', '[]', None),
+    (re.compile(r'Table \[\[.*?\]\]'), 'Table', 'Table [[', None),
+    (re.compile(r'\(#.*?\)'), '', '(#', None),
+    (re.compile(r'\[\[.*?\]\]'), '', '[[', None),
+    (re.compile(r'\n\s*\n\s*\n'), '\n\n', '\n', None),
+    # Absolute image paths under /figures/<chapter>/
+    (re.compile(r'<img src="(?!\/|http)([^"]+)"'), r'<img src="/\1"', '<img src="', ('tag',)),
+    (re.compile(r'!\[(.*?)\]\((?!\/|http)([^)]+)\)'), r'![\1](/\2)', '![', None),
+    (re.compile(r'!\[(.*?)\]\((?!\/|http)([^)]+)\)(\{[^}]*\})'), r'![\1](/\2)\3', '![', None),
+    (re.compile(r'!\[(.*?)\]\(([^)]+)\)(\{[^}]*\})?'), _fix_figure_path, '![', None),
+    (re.compile(r'!\[(.*?)\]\(figures/part1b/[^)]+/([^/)]+)\)(\{[^}]*\})?'), _fix_part1b_path,
+     '](figures/part1b/', None),
+    (re.compile(r'src="//+'), r'src="/', 'src="//', ('tag',)),
+    (re.compile(r'\]\(//+'), r'](/', '](//', None),
+    # Inline styles
+    (re.compile(r'<img([^>]*)style=\{[^}]*\}([^>]*)>'), r'<img\1\2>', 'style', ('tag',)),
+    (re.compile(r'<img([^>]*)style\s*=\s*\{[^}]*\}([^>]*)>'), r'<img\1\2>', 'style', ('tag',)),
+    (re.compile(r'<img([^>]*)style=\{\s*width:\s*"[^"]*"\s*\}([^>]*)>'), r'<img\1\2>', 'style', ('tag',)),
+    (re.compile(r'<img([^>]*)\bstyle\s*=\s*\{\s*[^}]*\s*\}([^>]*)>'), r'<img\1\2>', 'style', ('tag',)),
+    (re.compile(r'<(\w+)([^>]*)\bstyle\s*=\s*\{[^}]*\}([^>]*)>'), r'<\1\2\3>', 'style', ('tag',)),
+    (re.compile(r'<(\w+)([^>]*)  +([^>]*)>'), r'<\1\2 \3>', '  ', ('tag',)),
+    (re.compile(r'<(\w+)([^>]*) +>'), r'<\1\2>', ' >', ('tag',)),
+    (re.compile(r'!\[(.*?)\]\((.*?)\)(\{[^}]*\})'), r'![\1](\2)', '![', None),
+    (re.compile(r'!\[(.*?)\]\((.*?)\)(\{width="[^"]*"\})'), r'![\1](\2)', '![', None),
+    (re.compile(r'(!\[[^\]]*\]\([^)]*\))None\{width="[^"]*"\}'), r'\1', 'None{width=', None),
+]
+
+# Replacements that need the chapter name; skipped when it is unknown
+_CHAPTER_REPLACEMENTS = (_fix_figure_path, _fix_part1b_path)
+
+_SPAN_KINDS = ('code', 'table', 'tag', 'image', 'math', 'text')
+
+def _rules_by_kind(rules):
+    return {kind: [(pattern, replacement, guard) for pattern, replacement, guard, kinds in rules
+                   if kinds is None or kind in kinds]
+            for kind in _SPAN_KINDS}
+
+def _apply_rules(rules, text, chapter_name):
+    for pattern, replacement, guard in rules:
+        if guard not in text:
+            continue
+        if replacement in _CHAPTER_REPLACEMENTS:
+            if not chapter_name:
+                continue
+            text = pattern.sub(lambda match, fix=replacement: fix(match, chapter_name), text)
+        else:
+            text = pattern.sub(replacement, text)
+    return text
+
+def _prose_runs(spans):
+    """Merge consecutive text, math and image spans; the rules treat them alike."""
+    run = []
+    for kind, text in spans:
+        if kind in ('text', 'math', 'image'):
+            run.append(text)
+            continue
+        if run:
+            yield 'text', ''.join(run)
+            run = []
+        yield kind, text
+    if run:
+        yield 'text', ''.join(run)
+
+_PRE_HEADING_BY_KIND = _rules_by_kind(_PRE_HEADING_RULES)
+_PRE_HEADING_LABEL_BY_KIND = _rules_by_kind(_PRE_HEADING_LABEL_RULES)
+_POST_HEADING_BY_KIND = _rules_by_kind(_POST_HEADING_RULES)
+
+def _escaped_spans(chunks):
+    """Escape braces in markdown arriving in chunks and tokenize each chunk."""
+    previous = ''
+    for chunk in chunks:
+        if previous.endswith('\\') and chunk[:1] in ('{', '}'):
+            # The brace is already escaped by the end of the previous chunk
+            escaped = chunk[0] + _escape_braces(chunk[1:])
+        else:
+            escaped = _escape_braces(chunk)
+        if chunk:
+            previous = chunk
+        # Escaping only adds backslashes before braces, which moves no span boundary
+        yield from tokenize_markdown(escaped)
+
+# End of the text a heading fix-up can reach: its backslash or the end of the line
+_HEADING_END_RE = re.compile(r'[\\\n]')
+
+def iter_postprocess_markdown(chunks, chapter_name=''):
+    """Turn chunks of pandoc markdown holding whole blocks into MDX, yielding it as it becomes final."""
+    # The heading fix-up drops the first backslash after `#` and whitespace, but unlike the
+    # old whole-document pass never past the heading's line; spans wait until it resolves
+    held = []        # [kind, text] spans waiting on an open heading match
+    heading = None    # (held index, '#' offset, group start) of an open match
+
+    def finish(spans):
+        for kind, text in spans:
+            yield _apply_rules(_POST_HEADING_BY_KIND[kind], text, chapter_name)
+
+    for kind, escaped in _prose_runs(_escaped_spans(chunks)):
+        if kind == 'code':
+            # Code blocks lose the blank lines around their contents
+            escaped = f'```\n{escaped[3:-3].strip()}\n```'
+        escaped = _apply_rules(_PRE_HEADING_BY_KIND[kind], escaped, chapter_name)
+        if kind == 'table':
+            match = _TABLE_SPAN_RE.fullmatch(escaped)
+            if match:
+                escaped = format_center_table(match.group(1))
+        escaped = _apply_rules(_PRE_HEADING_LABEL_BY_KIND[kind], escaped, chapter_name)
+
+        held.append([kind, escaped])
+        index = len(held) - 1
+        position = 0
+        while True:
+            text = held[index][1]
+            if heading is None:
+                hash_at = text.find('#', position)
+                if hash_at < 0:
+                    break
+                ws_end = hash_at + 1
+                while ws_end < len(text) and text[ws_end].isspace() and text[ws_end] != '\n':
+                    ws_end += 1
+                if ws_end == hash_at + 1:
+                    # No whitespace after this `#`
+                    position = hash_at + 1
+                elif ws_end == len(text):
+                    # The whitespace runs to the end of the span; the next one decides
+                    heading = [index, hash_at, ws_end, False]
+                    break
+                elif text[ws_end] == '\\':
+                    if ws_end - hash_at - 1 >= 2:
+                        # Only whitespace before the backslash: its last character is the group
+                        held[index][1] = text[:hash_at] + '# ' + text[ws_end - 1] + text[ws_end + 1:]
+                        position = hash_at + 3
+                    else:
+                        position = ws_end
+                elif text[ws_end] == '\n':
+                    # The line ends before any backslash
+                    position = ws_end
                 else:
-                    grid_html += f'    <div>[Missing Image: {img["caption"]}]</div>\n'
-            
-            grid_html += '  </div>\n'
-            
-            # Add main caption if present
-            if main_caption:
-                grid_html += f'  <figcaption>{main_caption}</figcaption>\n'
-            
-            grid_html += '</figure>'
-            
-            return grid_html
-        
-        # If no subfigures were found, return the original content
-        return match.group(0)
-    
-    # Find figure environments containing subfigures
-    subfigure_pattern = r'\\begin\{figure\}(.*?\\begin\{subfigure\}.*?\\end\{subfigure\}.*?)\\end\{figure\}'
-    content = re.sub(subfigure_pattern, process_subfigure_environment, content, flags=re.DOTALL)
-    
-    return content
+                    heading = [index, hash_at, ws_end, True]
+                    position = ws_end + 1
+                continue
 
-def ensure_image_paths(content):
-    """Ensure all image paths in the MDX content have the correct format."""
-    # Fix any image src that might not have a leading slash in HTML tags
-    content = re.sub(r'<img src="(?!\/|http)([^"]+)"', r'<img src="/\1"', content)
-    
-    # Fix any image paths in Markdown format ![alt](path) 
-    content = re.sub(r'!\[(.*?)\]\((?!\/|http)([^)]+)\)', r'![\1](/\2)', content)
-    
-    # Also handle Markdown format with attributes ![alt](path){width="x"} 
-    content = re.sub(r'!\[(.*?)\]\((?!\/|http)([^)]+)\)(\{[^}]*\})', r'![\1](/\2)\3', content)
-    
-    # Convert any Markdown images to the chapter-specific path format
-    chapter_name = os.environ.get('CURRENT_CHAPTER_NAME', '')
-    if chapter_name:
-        # Handle paths that aren't already in the /figures/chapter structure
-        def fix_paths(match):
-            alt_text = match.group(1)
-            path = match.group(2)
-            attrs = match.group(3) if len(match.groups()) > 2 else ''
-            
-            # Skip if already in correct format
-            if re.match(r'^/figures/[^/]+/', path):
-                return f'![{alt_text}]({path}){attrs}'
-            
-            # Extract filename from path
-            filename = os.path.basename(path)
-            # Create new path in chapter figures directory
-            new_path = f'/figures/{chapter_name}/{filename}'
-            return f'![{alt_text}]({new_path}){attrs}'
-        
-        # Apply the path fixing to Markdown images
-        content = re.sub(r'!\[(.*?)\]\(([^)]+)\)(\{[^}]*\})?', fix_paths, content)
-        
-        # Handle the specific pattern with figures/part1b/... paths
-        # Specifically target the pattern shown in the example
-        content = re.sub(r'!\[(.*?)\]\(figures/part1b/[^)]+/([^/)]+)\)(\{[^}]*\})?', 
-                         lambda m: f'![{m.group(1)}](/figures/{chapter_name}/{m.group(2)}){m.group(3) if m.group(3) else ""}', 
-                         content)
-    
-    # Check and fix any malformed paths (double slashes, etc.)
-    content = re.sub(r'src="//+', r'src="/', content)
-    content = re.sub(r'\]\(//+', r'](/', content)
-    
-    return content
+            hash_index, hash_at, group_start, started = heading
+            if not started:
+                heading[3] = True
+                if text[0] == '\n':
+                    heading = None
+                    continue
+                if text[0] == '\\':
+                    heading = None
+                    if group_start - hash_at - 1 >= 2:
+                        hash_text = held[hash_index][1]
+                        held[hash_index][1] = hash_text[:hash_at] + '# ' + hash_text[group_start - 1:]
+                        held[index][1] = text[1:]
+                    continue
+            match = _HEADING_END_RE.search(text, position)
+            if match is None:
+                break
+            heading = None
+            backslash_at = match.start()
+            if match.group() == '\n':
+                # The line ends before any backslash
+                position = backslash_at
+                continue
+            text = text[:backslash_at] + text[backslash_at + 1:]
+            if hash_index == index:
+                held[index][1] = text[:hash_at] + '# ' + text[group_start:]
+                position = backslash_at - (group_start - hash_at - 2)
+            else:
+                held[index][1] = text
+                hash_text = held[hash_index][1]
+                held[hash_index][1] = hash_text[:hash_at] + '# ' + hash_text[group_start:]
+                position = backslash_at
 
-def remove_inline_styles(content):
-    """Remove inline style attributes from HTML tags in the MDX content."""
-    # Remove style attribute from img tags - handle various formats
-    content = re.sub(r'<img([^>]*)style=\{[^}]*\}([^>]*)>', r'<img\1\2>', content)
-    content = re.sub(r'<img([^>]*)style\s*=\s*\{[^}]*\}([^>]*)>', r'<img\1\2>', content)
-    
-    # Handle the specific format: style={ width: "40%" }
-    content = re.sub(r'<img([^>]*)style=\{\s*width:\s*"[^"]*"\s*\}([^>]*)>', r'<img\1\2>', content)
-    
-    # More general case with spaces and different attribute formats
-    content = re.sub(r'<img([^>]*)\bstyle\s*=\s*\{\s*[^}]*\s*\}([^>]*)>', r'<img\1\2>', content)
-    
-    # Remove style attribute from other tags
-    content = re.sub(r'<(\w+)([^>]*)\bstyle\s*=\s*\{[^}]*\}([^>]*)>', r'<\1\2\3>', content)
-    
-    # Clean up any double spaces or trailing/leading spaces in tag attributes
-    content = re.sub(r'<(\w+)([^>]*)  +([^>]*)>', r'<\1\2 \3>', content)
-    content = re.sub(r'<(\w+)([^>]*) +>', r'<\1\2>', content)
-    
-    # Fix markdown image style attributes as well - including width="x" format
-    content = re.sub(r'!\[(.*?)\]\((.*?)\)(\{[^}]*\})', r'![\1](\2)', content)
-    content = re.sub(r'!\[(.*?)\]\((.*?)\)(\{width="[^"]*"\})', r'![\1](\2)', content)
-    
-    # Handle the special case with None{width="2in"} format
-    content = re.sub(r'(!\[[^\]]*\]\([^)]*\))None\{width="[^"]*"\}', r'\1', content)
-    
-    return content
+        if heading is None:
+            yield from finish(held)
+            held = []
+        elif heading[0] > 0:
+            # Spans before the open `#` no longer depend on it
+            yield from finish(held[:heading[0]])
+            held = held[heading[0]:]
+            heading[0] = 0
+
+    # An unmatched `#` leaves its spans unchanged
+    yield from finish(held)
+
+def postprocess_markdown(md_content, chapter_name=''):
+    """Turn pandoc markdown into MDX; see iter_postprocess_markdown."""
+    return ''.join(iter_postprocess_markdown([md_content], chapter_name))
+
+# Paragraph put before and after a section in its pandoc input; pandoc copies
+# it through unchanged, marking where the section's own output is
+SECTION_MARKER = 'SECTIONBOUNDARYMARKER'
+
+# Commands whose numbers and labels other sections can refer to
+_OUTLINE_COMMANDS = ('chapter', 'section', 'subsection', 'subsubsection', 'label', 'macro')
 
-def convert_tex_to_mdx(tex_file, output_dir):
-    """Convert LaTeX file to MDX format."""
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+# Floats pandoc numbers; the outline keeps an empty one with the same caption and labels
+_OUTLINE_FLOATS = ('figure', 'figure*', 'table', 'table*')
 
+# Math environments pandoc passes through as TeX; it never resolves references to their labels
+_MATH_ENVIRONMENTS = ('equation', 'equation*', 'align', 'align*', 'gather', 'gather*', 'multline',
+                      'multline*', 'eqnarray', 'eqnarray*', 'flalign', 'flalign*', 'alignat', 'alignat*',
+                      'split', 'aligned', 'gathered')
+
+# Cross-references, possibly to several comma-separated labels
+_TEX_REF_RE = re.compile(r'\\(?:[cC]ref|autoref|eqref|ref|pageref|nameref)\*?\{([^}]*)\}')
+
+# Commands whose output pandoc gathers at the end of the document; chapters
+# using them are converted in one piece
+_DOCUMENT_LEVEL_COMMANDS = ('\\footnote', '\\cite', '\\bibliography', '\\printbibliography')
+
+def split_sections_of(content, index):
+    """Yield one pandoc input per top-level section, or return None if the chapter cannot be split."""
+    if any(command in content for command in _DOCUMENT_LEVEL_COMMANDS):
+        return None
+    documents = index.find('document')
+    if documents:
+        body_start, body_end = documents[0].body_start, documents[0].body_end
+        preamble, closing = content[:body_start], '\n\\end{document}\n'
+    else:
+        body_start, body_end = 0, len(content)
+        preamble, closing = '', ''
+
+    def top_level(span):
+        return span.environment in (None, 'document') and body_start <= span.start < body_end
+
+    cuts = [span.start for span in index.find('section') if top_level(span)]
+    if not cuts:
+        return None
+
+    outline = []
+    outlined_labels = set()
+    for kind in _OUTLINE_COMMANDS:
+        outline += [(span.start, span.text) for span in index.find(kind) if top_level(span)]
+    for kind in _OUTLINE_FLOATS:
+        for float_span in index.find(kind):
+            if top_level(float_span):
+                # Floats only need their number and labels; pandoc numbers a table
+                # only if it has a tabular
+                caption = '\\caption{}' if float_span.first('caption') else ''
+                labels = float_span.find('label')
+                tabular = '\\begin{tabular}{l}\\end{tabular}' if kind.startswith('table') else ''
+                outline.append((float_span.start, f'\\begin{{{kind}}}{caption}'
+                                f'{"".join(label.text for label in labels)}{tabular}\\end{{{kind}}}'))
+                outlined_labels.update(label.start for label in labels)
+    outline.sort()
+
+    bounds = [body_start] + cuts + [body_end]
+    # A reference to a label the outline leaves out, such as one in a theorem
+    # or a subfigure, only resolves within the piece that has the label
+    pieces = {label.body.strip(): bisect.bisect_right(bounds, label.start)
+              for label in index.find('label')
+              if not top_level(label) and label.start not in outlined_labels
+              and label.environment not in _MATH_ENVIRONMENTS}
+    for match in _TEX_REF_RE.finditer(content):
+        for name in match.group(1).split(','):
+            piece = pieces.get(name.strip())
+            if piece is not None and piece != bisect.bisect_right(bounds, match.start()):
+                return None
+
+    def inputs():
+        for start, end in zip(bounds, bounds[1:]):
+            before = '\n'.join(text for position, text in outline if position < start)
+            after = '\n'.join(text for position, text in outline if position >= end)
+            yield (f'{preamble}{before}\n\n{SECTION_MARKER}\n\n{content[start:end]}'
+                   f'\n\n{SECTION_MARKER}\n\n{after}{closing}')
+    return inputs()
+
+def convert_sections(inputs, cache=None, workers=1, profile=None):
+    """Convert section inputs from split_sections_of with pandoc and yield their markdown in order."""
+    version = pypandoc.get_pandoc_version()
+
+    def convert(pandoc_input):
+        output = pypandoc.convert_text(pandoc_input, 'markdown', format='latex')
+        if profile:
+            profile.count_subprocess('pandoc')
+        parts = output.split(SECTION_MARKER)
+        if len(parts) != 3:
+            raise ValueError("section boundary lost in pandoc output")
+        return parts[1].strip('\n')
+
+    workers = max(1, workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        window = []
+        pending = iter(inputs)
+        while True:
+            # Keep the window full
+            while len(window) < 2 * workers:
+                pandoc_input = next(pending, None)
+                if pandoc_input is None:
+                    break
+                key = hashlib.sha256(f'{version}\0{pandoc_input}'.encode('utf-8')).hexdigest()
+                markdown = cache.read(key) if cache else None
+                if markdown is not None:
+                    window.append((key, None, markdown))
+                else:
+                    window.append((key, executor.submit(convert, pandoc_input), None))
+            if not window:
+                break
+            key, future, markdown = window.pop(0)
+            if future:
+                markdown = future.result()
+                if cache:
+                    cache.write(key, markdown)
+            yield markdown
+
+def _section_chunks(markdowns, profile, prepare=None):
+    """Join section markdown the way pandoc separates blocks of one document."""
+    first = True
+    for markdown in markdowns:
+        profile.counters['sections'] = profile.counters.get('sections', 0) + 1
+        profile.sizes['markdown'] = profile.sizes.get('markdown', 0) + len(markdown.encode('utf-8'))
+        if prepare:
+            markdown = prepare(markdown)
+        if not markdown:
+            continue
+        yield markdown if first else '\n\n' + markdown
+        first = False
+    yield '\n'
+
+def iter_sections_mdx(sections, chapter_name, cache=None, workers=1, profile=None,
+                      prepare=None, finish=None, stage=None):
+    """Convert section inputs and yield the post-processed MDX of the chapter in pieces."""
+    if profile is None:
+        profile = BuildProfile()
+    hits = cache.hits if cache else 0
+    profile.counters['sections'] = 0
+    with (stage or profile.stage)('sections'):
+        markdowns = convert_sections(sections, cache, workers, profile)
+        chunks = _section_chunks(markdowns, profile, prepare)
+        for text in iter_postprocess_markdown(chunks, chapter_name):
+            yield finish(text) if finish else text
+    profile.counters['cached_sections'] = (cache.hits - hits) if cache else 0
+
+# Node script that keeps KaTeX loaded and renders one equation per request line
+KATEX_WORKER = os.path.join(PROJECT_ROOT, 'scripts', 'katex-render.js')
+
+# Stands in for a pre-rendered equation until post-processing is done
+_MATH_PLACEHOLDER_RE = re.compile(r'KATEXMATH(\d+)X')
+
+class KatexRenderer:
+    """A long-running KaTeX process, spawned on first use and shared by threads."""
+
+    def __init__(self, command=None):
+        self.command = command or ['node', KATEX_WORKER]
+        self.version = None
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # Called with the lock held
+        self._process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         text=True, encoding='utf-8', cwd=PROJECT_ROOT)
+        hello = self._process.stdout.readline()
+        if not hello:
+            self.close()
+            raise RuntimeError(f"KaTeX worker exited: {' '.join(self.command)}")
+        self.version = json.loads(hello)['version']
+
+    def katex_version(self):
+        """The KaTeX version of the worker, starting it if needed."""
+        with self._lock:
+            if self._process is None:
+                self._start()
+        return self.version
+
+    def render(self, tex, display=False):
+        """Return the HTML and MathML of an equation; raises ValueError if KaTeX rejects it."""
+        with self._lock:
+            if self._process is None:
+                self._start()
+            self._process.stdin.write(json.dumps({'tex': tex, 'display': display}) + '\n')
+            self._process.stdin.flush()
+            line = self._process.stdout.readline()
+        if not line:
+            self.close()
+            raise RuntimeError("KaTeX worker exited")
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise ValueError(reply['error'])
+        return reply['html']
+
+    def close(self):
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.wait()
+            self._process = None
+
+_katex_renderer = None
+_katex_renderer_lock = threading.Lock()
+
+def get_katex_renderer():
+    """The KaTeX process of this converter process, started on first use."""
+    global _katex_renderer
+    with _katex_renderer_lock:
+        if _katex_renderer is None:
+            _katex_renderer = KatexRenderer()
+            atexit.register(_katex_renderer.close)
+    return _katex_renderer
+
+class MathPrerender:
+    """Pre-render the math of pandoc's markdown with KaTeX, around post-processing."""
+
+    def __init__(self, renderer=None, cache=None, profile=None, warn=print):
+        self.renderer = renderer or get_katex_renderer()
+        self.cache = cache
+        self.profile = profile
+        self.warn = warn
+        self.rendered = []
+        self.failed = 0
+        self._memo = {}
+        self._disabled = False
+
+    def _render(self, tex, display):
+        if (tex, display) in self._memo:
+            return self._memo[tex, display]
+        version = self.renderer.katex_version()
+        key = hashlib.sha256(f'{version}\0{int(display)}\0{tex}'.encode('utf-8')).hexdigest()
+        markup = self.cache.read(key) if self.cache else None
+        if markup is None:
+            try:
+                markup = self.renderer.render(tex, display)
+            except ValueError as e:
+                self.warn(f"Warning: leaving math for the browser, KaTeX cannot render {tex!r}: {e}")
+                self.failed += 1
+                markup = None
+            else:
+                if self.cache:
+                    self.cache.write(key, markup)
+                if self.profile:
+                    self.profile.counters['math_rendered'] = self.profile.counters.get('math_rendered', 0) + 1
+        self._memo[tex, display] = markup
+        return markup
+
+    def _placeholder(self, match):
+        text = match.group(0)
+        display = text.startswith('$$')
+        tex = text[2:-2] if display else text[1:-1]
+        markup = self._render(tex.strip(), display)
+        if markup is None:
+            return text
+        self.rendered.append((markup, display))
+        return f'KATEXMATH{len(self.rendered) - 1}X'
+
+    def extract(self, md_content):
+        """Replace the math spans outside code with placeholders."""
+        if self._disabled:
+            return md_content
+        try:
+            parts = []
+            for kind, text in tokenize_markdown(md_content):
+                # Math in `::: center` tables stays as it is: format_center_table
+                # finds the rows by their `$`
+                if kind == 'math':
+                    text = _MATH_SPAN_RE.sub(self._placeholder, text)
+                parts.append(text)
+            return ''.join(parts)
+        except (OSError, RuntimeError) as e:
+            # Placeholders handed out so far stay valid for restore()
+            self.warn(f"Warning: KaTeX is not available ({e}); math will be typeset in the browser")
+            self._disabled = True
+            return md_content
+
+    def restore(self, mdx_content):
+        """Swap the placeholders in post-processed MDX for the rendered markup."""
+        def markup(match):
+            html_markup, display = self.rendered[int(match.group(1))]
+            class_name = 'math math-display' if display else 'math math-inline'
+            return (f'<span className="{class_name}" '
+                    f'dangerouslySetInnerHTML={{{{__html: {json.dumps(html_markup)}}}}} />')
+        return _MATH_PLACEHOLDER_RE.sub(markup, mdx_content)
+
+_TAG_ATTRIBUTE_RE = re.compile(r'(\w+)="([^"]*)"')
+_WORD_RE = re.compile(r"\w+(?:['’-]\w+)*")
+def _add_headings(stack, mdx_content):
+    # Hang the headings of whole blocks of MDX into the tree whose open path is `stack`
+    for level, text, _ in mdx_sections(mdx_content)[1:]:
+        text = _PRERENDERED_MATH_RE.sub(_plain_math, text).strip()
+        heading = {'level': level, 'text': text, 'slug': sluggify(text), 'children': []}
+        while stack[-1]['level'] >= level:
+            stack.pop()
+        stack[-1]['children'].append(heading)
+        stack.append(heading)
+
+def mdx_headings(mdx_content):
+    """Return the headings outside code blocks as a tree of {level, text, slug, children}."""
+    root = {'level': 0, 'children': []}
+    _add_headings([root], mdx_content)
+    return root['children']
+
+def _figure(match):
+    # {src, alt[, width, height]} of an image reference
+    if match.group('tag'):
+        attributes = dict(_TAG_ATTRIBUTE_RE.findall(match.group('tag')))
+        figure = {'src': attributes.get('src', ''), 'alt': html.unescape(attributes.get('alt', ''))}
+        for dimension in ('width', 'height'):
+            if attributes.get(dimension, '').isdigit():
+                figure[dimension] = int(attributes[dimension])
+        return figure
+    return {'src': match.group('path'), 'alt': re.sub(r'\\(.)', r'\1', match.group('alt'))}
+
+def chapter_metadata(mdx_content, title, source_hash):
+    """Describe a converted chapter for the site, which reads this instead of the MDX."""
+    metadata = ChapterMetadata(title, source_hash)
+    metadata.feed(mdx_content)
+    return metadata.metadata()
+
+def _whole_blocks_end(mdx_content):
+    # End of the longest prefix that splits off at a blank line without cutting
+    # a code block, a center table or a tag in two, or 0
+    cut = mdx_content.rfind('\n\n') + 2
+    prefix = mdx_content[:cut]
+    if cut < 2 or prefix.count('```') % 2:
+        return 0
+    table = prefix.rfind('::: center\n')
+    if table >= 0 and prefix.find('\n:::', table + len('::: center\n')) < 0:
+        return 0
+    if _TAG_START_RE.search(prefix, prefix.rfind('>') + 1):
+        return 0
+    return cut
+
+_TAG_START_RE = re.compile(r'<\w')
+
+class ChapterMetadata:
+    """chapter_metadata and mdx_assets for MDX fed in pieces, such as a chapter streamed to disk."""
+
+    def __init__(self, title, source_hash):
+        self.title = title
+        self.source_hash = source_hash
+        self.size = 0
+        self.figures = []
+        self.word_count = 0
+        self.urls = set()
+        self.headings = {'level': 0, 'children': []}
+        self._stack = [self.headings]
+        self._held = []
+
+    def feed(self, mdx_piece):
+        """Take the next piece of the MDX."""
+        self.size += len(mdx_piece.encode('utf-8'))
+        self._held.append(mdx_piece)
+        if '\n' in mdx_piece:
+            held = ''.join(self._held)
+            cut = _whole_blocks_end(held)
+            self._held = [held[cut:]]
+            self._add(held[:cut])
+
+    def _add(self, mdx_content):
+        for kind, text in tokenize_markdown(_PRERENDERED_MATH_RE.sub(' ', mdx_content)):
+            if kind == 'image' or (kind == 'tag' and text.startswith('<img')):
+                match = _IMAGE_REFERENCE_RE.match(text)
+                if match:
+                    self.figures.append(_figure(match))
+            elif kind in ('text', 'table'):
+                if ':::' in text:
+                    text = _FENCED_DIV_RE.sub('', text)
+                self.word_count += len(_WORD_RE.findall(text))
+        _add_headings(self._stack, mdx_content)
+        self.urls.update(referenced_figures(mdx_content))
+
+    def _flush(self):
+        self._add(''.join(self._held))
+        self._held = []
+
+    def metadata(self):
+        """The meta.json contents of the MDX fed so far."""
+        self._flush()
+        return {
+            'title': self.title,
+            'headings': self.headings['children'],
+            'figures': self.figures,
+            'word_count': self.word_count,
+            'source_hash': self.source_hash,
+        }
+
+    def assets(self):
+        """The assets of the MDX fed so far, as mdx_assets lists them."""
+        self._flush()
+        return _assets(sorted(self.urls))
+
+def write_chapter_metadata(meta_file, metadata):
+    """Write the meta.json sidecar of a converted chapter."""
+    with atomic_write(meta_file) as f:
+        json.dump(metadata, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+
+def mdx_assets(mdx_content):
+    """List the files under public/ an MDX document references, as {url, path, stored}."""
+    return _assets(referenced_figures(mdx_content))
+
+def _assets(urls):
+    assets = []
+    for url in urls:
+        assets.append({
+            'url': url,
+            'path': os.path.join(PROJECT_ROOT, 'public', url.lstrip('/')),
+            'stored': url.startswith(f'/figures/{FIGURE_STORE}/'),
+        })
+    return assets
+
+class ConversionConfig:
+    """Options of a conversion, with the defaults of the converter."""
+
+    def __init__(self, tikz_cache=None, tikz_workers=1, tikz_batch=False, tikz_settings=TIKZ_RENDER_SETTINGS,
+                 split_sections=False, section_workers=1, section_cache=None, image_variants=True,
+                 image_workers=1, image_cache=None, prerender_math=False, math_cache=None):
+        self.tikz_cache = tikz_cache
+        self.tikz_workers = tikz_workers
+        self.tikz_batch = tikz_batch
+        self.tikz_settings = tikz_settings
+        self.split_sections = split_sections
+        self.section_workers = section_workers
+        self.section_cache = section_cache
+        self.image_variants = image_variants
+        self.image_workers = image_workers
+        self.image_cache = image_cache
+        self.prerender_math = prerender_math
+        self.math_cache = math_cache
+
+class ConversionContext:
+    """The state of one conversion: its chapter, options, profile and diagnostics."""
+
+    def __init__(self, chapter_name, config=None, profile=None):
+        self.chapter_name = chapter_name
+        self.config = config or ConversionConfig()
+        self.profile = profile or BuildProfile(chapter_name)
+        self.diagnostics = []
+        self.current_stage = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage in the profile and attribute diagnostics to it."""
+        previous = self.current_stage
+        self.current_stage = name
+        with self.profile.stage(name):
+            yield
+        # Left as is when the stage raises, so the error is reported against it
+        self.current_stage = previous
+
+    def report(self, level, message):
+        with self._lock:
+            self.diagnostics.append({'level': level, 'stage': self.current_stage, 'message': message})
+
+    def info(self, message):
+        self.report('info', message)
+
+    def warn(self, message):
+        self.report('warning', message)
+
+class ConversionResult:
+    """What convert_tex produces: the MDX, its title and metadata, assets and diagnostics."""
+
+    def __init__(self, mdx, title, metadata, assets, diagnostics):
+        self.mdx = mdx
+        self.title = title
+        self.metadata = metadata
+        self.assets = assets
+        self.diagnostics = diagnostics
+
+class ConversionError(Exception):
+    """A conversion failed; carries the diagnostics reported up to the failure."""
+
+    def __init__(self, message, diagnostics):
+        super().__init__(message)
+        self.diagnostics = diagnostics
+
+def convert_tex(tex_source, chapter_name, config=None, profile=None, output=None):
+    """Convert LaTeX source to MDX and return a ConversionResult; raises ConversionError on failure."""
+    context = ConversionContext(chapter_name, config, profile)
     try:
-        with open(tex_file, 'r') as file:
-            content = file.read()
-
-        # Set environment variable for current chapter name for path fixing
-        chapter_name = os.path.splitext(os.path.basename(tex_file))[0]
-        os.environ['CURRENT_CHAPTER_NAME'] = chapter_name
-        
-        title = extract_title(content)
-        
-        # Process subfigures first, they're more complex
-        content = handle_subfigures(content, tex_file, output_dir)
-        
-        # Process TikZ diagrams before conversion
-        content = extract_and_render_tikz(content, tex_file, output_dir)
-
-        md_content = pypandoc.convert_text(content, 'markdown', format='latex')
-
-        mdx_content = escape_braces(md_content)
-        mdx_content = remove_language_references(mdx_content)
-
-        mdx_content = clean_code_blocks(mdx_content)
-        mdx_content = fix_set_notation(mdx_content)
-        mdx_content = fix_math_delimiters(mdx_content)
-        mdx_content = format_tables(mdx_content)
-        mdx_content = remove_labels(mdx_content)
-        
-        # Handle regular images
-        mdx_content = handle_images(mdx_content, tex_file, output_dir)
-        
-        # Ensure all image paths are correct
-        mdx_content = ensure_image_paths(mdx_content)
-        
-        # Remove any inline styles from HTML tags
-        mdx_content = remove_inline_styles(mdx_content)
-        
-        mdx_file = os.path.join(output_dir, 'index.mdx')
-        with open(mdx_file, 'w') as file:
-            file.write(mdx_content)
-
-        print(f"Successfully converted {tex_file} to {mdx_file}")
-        print(f"Title: {title}")
+        return _convert(tex_source, context, output)
+    except Exception as e:
+        context.report('error', str(e))
+        raise ConversionError(f"{chapter_name}: {e}", context.diagnostics) from e
+
+def _convert(content, context, output=None):
+    config, profile, chapter_name = context.config, context.profile, context.chapter_name
+    profile.sizes['tex'] = len(content.encode('utf-8'))
+    title = extract_title(content)
+    source_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    # Caches outlive a conversion, as in watch mode; report what this one used
+    caches = [config.tikz_cache, config.section_cache, config.image_cache, config.math_cache]
+    started = {cache: cache.counts() for cache in caches if cache}
+
+    def report(cache):
+        context.info(cache.report(started[cache]))
 
+    # Index the environments once; rescan only if the subfigures changed the source
+    with context.stage('scan'):
+        index = scan_tex(content)
+
+    # Process subfigures first, they're more complex
+    with context.stage('subfigures'):
+        processed = handle_subfigures(content, chapter_name, index=index)
+        if processed != content:
+            content = processed
+            index = scan_tex(content)
+
+    # Process TikZ diagrams before conversion
+    tikz_code = []
+    with context.stage('tikz'):
+        content = extract_and_render_tikz(content, chapter_name, cache=config.tikz_cache,
+                                          workers=config.tikz_workers, batch=config.tikz_batch,
+                                          settings=config.tikz_settings, index=index, profile=profile,
+                                          warn=context.warn, fallbacks=tikz_code)
+    if config.tikz_cache:
+        report(config.tikz_cache)
+
+    math = None
+    if config.prerender_math:
+        math = MathPrerender(cache=config.math_cache, profile=profile, warn=context.warn)
+
+    def prepare(markdown):
+        if config.image_variants:
+            with context.stage('images'):
+                markdown = responsive_images(markdown, chapter_name, config.image_cache, config.image_workers,
+                                             profile=profile, warn=context.warn)
+        if math:
+            with context.stage('math'):
+                markdown = math.extract(markdown)
+        return markdown
+
+    def finish(mdx_content):
+        if math:
+            with context.stage('math'):
+                mdx_content = math.restore(mdx_content)
+        return restore_tikz_code(mdx_content, tikz_code) if tikz_code else mdx_content
+
+    # The metadata is taken from the MDX as it comes out, so a streamed chapter is never read back
+    meta = None
+    mdx_content = None
+    if config.split_sections:
+        with context.stage('split'):
+            sections = split_sections_of(content, scan_tex(content))
+        if sections:
+            meta = ChapterMetadata(title, source_hash)
+            parts = []
+            try:
+                for piece in iter_sections_mdx(sections, chapter_name, config.section_cache,
+                                               config.section_workers, profile, prepare, finish,
+                                               context.stage):
+                    meta.feed(piece)
+                    if output is None:
+                        parts.append(piece)
+                    else:
+                        output.write(piece)
+                mdx_content = ''.join(parts)
+                context.info(f"Converted in {profile.counters['sections']} sections")
+                if config.section_cache:
+                    report(config.section_cache)
+            except ValueError as e:
+                meta = None
+                if output is not None:
+                    output.seek(0)
+                    output.truncate()
+                context.info(f"Converting in one piece: {e}")
+                # The sections stage is abandoned, not failed; what follows is not part of it
+                context.current_stage = None
+
+    if meta is None:
+        with context.stage('pandoc'):
+            md_content = pypandoc.convert_text(content, 'markdown', format='latex')
+        profile.count_subprocess('pandoc')
+        profile.sizes['markdown'] = len(md_content.encode('utf-8'))
+
+        md_content = prepare(md_content)
+        with context.stage('postprocess'):
+            mdx_content = postprocess_markdown(md_content, chapter_name)
+        mdx_content = finish(mdx_content)
+        if output is not None:
+            output.write(mdx_content)
+        with context.stage('meta'):
+            meta = ChapterMetadata(title, source_hash)
+            meta.feed(mdx_content)
+
+    if config.image_variants and config.image_cache:
+        report(config.image_cache)
+    if math and config.math_cache:
+        report(config.math_cache)
+    profile.sizes['mdx'] = meta.size
+
+    with context.stage('meta'):
+        metadata = meta.metadata()
+        assets = meta.assets()
+    return ConversionResult(mdx_content if output is None else None, title, metadata, assets,
+                            context.diagnostics)
+
+def print_diagnostics(diagnostics):
+    for diagnostic in diagnostics:
+        print(diagnostic['message'])
+
+def convert_tex_to_mdx(tex_file, output_dir, profile=None, **options):
+    """Convert a LaTeX file to <output_dir>/index.mdx and meta.json. Returns True on success."""
+    if profile is None:
+        profile = BuildProfile()
+    chapter_name = os.path.splitext(os.path.basename(tex_file))[0]
+    mdx_file = os.path.join(output_dir, 'index.mdx')
+    try:
+        with profile.stage('read'):
+            with open(tex_file, 'r') as file:
+                content = file.read()
+        os.makedirs(output_dir, exist_ok=True)
+        with atomic_write(mdx_file, 'w+') as output:
+            result = convert_tex(content, chapter_name, ConversionConfig(**options), profile, output)
+    except ConversionError as e:
+        print_diagnostics(e.diagnostics[:-1])
+        cause = e.__cause__
+        print(f"Error converting {tex_file}: {cause}")
+        traceback.print_exception(type(cause), cause, cause.__traceback__)
+        return False
     except Exception as e:
         print(f"Error converting {tex_file}: {e}")
-        import traceback
         traceback.print_exc()
+        return False
+    print_diagnostics(result.diagnostics)
+
+    with profile.stage('write'):
+        write_chapter_metadata(os.path.join(output_dir, META_NAME), result.metadata)
+
+    print(f"Successfully converted {tex_file} to {mdx_file}")
+    print(f"Title: {result.title}")
+    return True
+
+MANIFEST_NAME = '.build-manifest.json'
+
+def converter_fingerprint(options):
+    """Identify the converter code and the output-affecting options of a build."""
+    return {
+        'version': file_hash(os.path.abspath(__file__)),
+        'tikz_settings': options.get('tikz_settings', TIKZ_RENDER_SETTINGS),
+        'image_settings': IMAGE_VARIANT_SETTINGS if options.get('image_variants', True) else None,
+        'prerender_math': options.get('prerender_math', False),
+    }
+
+def find_chapter_inputs(tex_file):
+    """List the files a chapter pulls in through \\input, \\include, \\subfile and \\includegraphics."""
+    tex_dir = os.path.dirname(os.path.abspath(tex_file))
+    with open(tex_file, 'r') as f:
+        content = f.read()
+    # Ignore commented-out lines
+    content = re.sub(r'(?<!\\)%.*', '', content)
+    inputs = []
+    for path in re.findall(r'\\(?:input|include|subfile)\{([^}]*)\}', content):
+        path = os.path.join(tex_dir, path.strip())
+        inputs.append(path if os.path.splitext(path)[1] else path + '.tex')
+    chapter_name = os.path.splitext(os.path.basename(tex_file))[0]
+    for path in re.findall(r'\\includegraphics(?:\[[^\]]*\])?\{([^}]*)\}', content):
+        inputs.append(os.path.join(tex_dir, path.strip()))
+        # The copy under public/ the image stage reads
+        inputs.append(_image_file(_image_url(path.strip(), chapter_name))[1])
+    return sorted(set(inputs))
+
+def referenced_figures(mdx_content):
+    """Return the /figures/... URLs referenced by an MDX document."""
+    return sorted(set(re.findall(r'/figures/[^\s"\\)<>]+', mdx_content)))
+
+def chapter_outputs(output_dir):
+    """The generated index.mdx and meta.json plus every public figure the MDX references."""
+    mdx_file = os.path.join(output_dir, 'index.mdx')
+    outputs = [mdx_file, os.path.join(output_dir, META_NAME)]
+    if os.path.exists(mdx_file):
+        with open(mdx_file, 'r') as f:
+            for url in referenced_figures(f.read()):
+                path = os.path.join(PROJECT_ROOT, 'public', url.lstrip('/'))
+                if os.path.isfile(path):
+                    outputs.append(path)
+    return outputs
+
+class BuildManifest:
+    """Per-chapter record of build inputs and outputs, used to skip unchanged chapters."""
+
+    def __init__(self, path):
+        self.path = path
+        self.chapters = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.chapters = json.load(f).get('chapters', {})
+
+    @staticmethod
+    def _relative(path):
+        return os.path.relpath(os.path.abspath(path), PROJECT_ROOT)
+
+    def _hashes(self, paths):
+        return {self._relative(path): file_hash(path) for path in paths}
+
+    def dirty_reason(self, tex_file, output_dir, fingerprint):
+        """Return why a chapter must be rebuilt, or None if it is up to date."""
+        entry = self.chapters.get(self._relative(tex_file))
+        if entry is None:
+            return "not built yet"
+        if entry['converter'] != fingerprint:
+            return "converter or options changed"
+        if entry['source'] != file_hash(tex_file):
+            return "source changed"
+        if entry['output_dir'] != self._relative(output_dir):
+            return "output directory changed"
+        for path, digest in entry['inputs'].items():
+            if file_hash(os.path.join(PROJECT_ROOT, path)) != digest:
+                return f"{path} changed"
+        for path, digest in entry['outputs'].items():
+            if file_hash(os.path.join(PROJECT_ROOT, path)) != digest:
+                return f"{path} missing or modified"
+        return None
+
+    def record(self, tex_file, output_dir, fingerprint):
+        """Store the current state of a freshly converted chapter."""
+        self.chapters[self._relative(tex_file)] = {
+            'source': file_hash(tex_file),
+            'inputs': self._hashes(find_chapter_inputs(tex_file)),
+            'converter': fingerprint,
+            'output_dir': self._relative(output_dir),
+            'outputs': self._hashes(chapter_outputs(output_dir)),
+        }
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with atomic_write(self.path) as f:
+            json.dump({'chapters': self.chapters}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+def collect_figures(mdx_files, dry_run=False):
+    """Delete the figure store entries no MDX file references; returns the paths and bytes freed."""
+    store_dir = os.path.join(PROJECT_ROOT, 'public', 'figures', FIGURE_STORE)
+    keep = set()
+    for mdx_file in mdx_files:
+        with open(mdx_file, 'r') as f:
+            for url in referenced_figures(f.read()):
+                keep.add(os.path.normpath(os.path.join(PROJECT_ROOT, 'public', url.lstrip('/'))))
+
+    removed = []
+    for directory, _, files in os.walk(store_dir):
+        removed.extend(path for path in (os.path.join(directory, name) for name in files)
+                       if os.path.normpath(path) not in keep)
+
+    # A file only frees its space when the last of its hardlinks goes
+    reclaimed, unlinked = 0, {}
+    for path in removed:
+        stat = os.stat(path)
+        inode = (stat.st_dev, stat.st_ino)
+        unlinked[inode] = unlinked.get(inode, 0) + 1
+        if unlinked[inode] == stat.st_nlink:
+            reclaimed += stat.st_size
+    if not dry_run:
+        for path in removed:
+            os.remove(path)
+        for directory, _, _ in os.walk(store_dir, topdown=False):
+            if directory != store_dir and not os.listdir(directory):
+                os.rmdir(directory)
+    return removed, reclaimed
+
+DEFAULT_OUTPUT_ROOT = os.path.join(PROJECT_ROOT, 'contents', 'docs', 'chapters')
+
+def collect_chapters(paths):
+    """Expand chapter files and directories of chapters into a sorted list of .tex files."""
+    tex_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            tex_files.extend(sorted(glob.glob(os.path.join(path, '*.tex'))))
+        else:
+            tex_files.append(path)
+    return tex_files
+
+def convert_chapter(tex_file, output_dir, options, profile=False, cprofile_dir=None):
+    """Convert one chapter and summarize the outcome; runs inside the batch process pool."""
+    chapter_name = os.path.splitext(os.path.basename(tex_file))[0]
+    build_profile = BuildProfile(chapter_name)
+    start = time.perf_counter()
+    if cprofile_dir:
+        profiler = cProfile.Profile()
+        ok = profiler.runcall(convert_tex_to_mdx, tex_file, output_dir, profile=build_profile, **options)
+        os.makedirs(cprofile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(cprofile_dir, f'{chapter_name}.prof'))
+    else:
+        ok = convert_tex_to_mdx(tex_file, output_dir, profile=build_profile, **options)
+    # Counted from this conversion's diagrams; the cache's counters span the whole process
+    cached = sum(1 for diagram in build_profile.diagrams if diagram['status'] == 'cached')
+    result = {
+        'chapter': chapter_name,
+        'ok': ok,
+        'seconds': time.perf_counter() - start,
+        'tikz_hits': cached,
+        'tikz_misses': len(build_profile.diagrams) - cached,
+    }
+    if profile:
+        profile_report = build_profile.report()
+        profile_report['wall'] = result['seconds']
+        result['profile'] = profile_report
+    return result
+
+def plan_builds(chapters, manifest, fingerprint, force=False):
+    """Split (tex_file, output_dir) pairs into those to rebuild, with a reason, and those to skip."""
+    dirty, clean = [], []
+    for tex_file, output_dir in chapters:
+        reason = "forced" if force else manifest.dirty_reason(tex_file, output_dir, fingerprint)
+        if reason:
+            dirty.append((tex_file, output_dir, reason))
+        else:
+            clean.append((tex_file, output_dir))
+    return dirty, clean
+
+# Options sizing the thread pools of a single chapter's conversion
+_WORKER_OPTIONS = ('tikz_workers', 'section_workers', 'image_workers')
+
+def convert_batch(tex_files, output_root, options, jobs=None, force=False, profile=False, cprofile_dir=None,
+                  search_index=None):
+    """Convert several chapters in parallel on a process pool, skipping those that are up to date."""
+    chapters = [(tex_file, os.path.join(output_root, os.path.splitext(os.path.basename(tex_file))[0]))
+                for tex_file in tex_files]
+    manifest = BuildManifest(os.path.join(output_root, MANIFEST_NAME))
+    fingerprint = converter_fingerprint(options)
+    dirty, _ = plan_builds(chapters, manifest, fingerprint, force)
+    dirty_files = set(tex_file for tex_file, _, _ in dirty)
+
+    results = {}
+    if dirty:
+        parallel = min(jobs or os.cpu_count() or 1, len(dirty))
+        chapter_options = dict(options, **{key: max(1, options[key] // parallel)
+                                           for key in _WORKER_OPTIONS if key in options})
+        with ProcessPoolExecutor(max_workers=parallel) as executor:
+            futures = {tex_file: executor.submit(convert_chapter, tex_file, output_dir, chapter_options,
+                                                 profile, cprofile_dir)
+                       for tex_file, output_dir, _ in dirty}
+            for tex_file, output_dir, _ in dirty:
+                results[tex_file] = futures[tex_file].result()
+                if results[tex_file]['ok']:
+                    manifest.record(tex_file, output_dir, fingerprint)
+        manifest.save()
+    if search_index:
+        update_search_index(search_index, [(os.path.splitext(os.path.basename(tex_file))[0], output_dir)
+                                           for tex_file, output_dir in chapters])
+
+    summaries = []
+    for tex_file, _ in chapters:
+        if tex_file in dirty_files:
+            summaries.append(results[tex_file])
+        else:
+            summaries.append({'chapter': os.path.splitext(os.path.basename(tex_file))[0],
+                              'ok': True, 'skipped': True})
+    return summaries
+
+def update_search_index(search_index, chapters):
+    """Update a SearchIndex for (chapter name, output directory) pairs and report what changed."""
+    start = time.perf_counter()
+    indexed, shards = search_index.update(chapters)
+    if indexed or shards:
+        print(f"Search index: {indexed} chapters indexed, {shards} shards written "
+              f"({(time.perf_counter() - start) * 1000:.0f} ms)")
+
+def print_batch_summary(results):
+    """Print one parseable line per chapter: [ok] or [failed], name, time, TikZ cache use."""
+    print("\nConversion summary:")
+    for result in results:
+        status = 'ok' if result['ok'] else 'failed'
+        if result.get('skipped'):
+            print(f"[{status}] {result['chapter']} (up to date, skipped)")
+        else:
+            print(f"[{status}] {result['chapter']} ({result['seconds']:.2f}s, "
+                  f"TikZ {result['tikz_hits']} cached / {result['tikz_misses']} rendered)")
+    skipped = sum(1 for result in results if result.get('skipped'))
+    failed = sum(1 for result in results if not result['ok'])
+    print(f"{len(results) - skipped - failed} converted, {skipped} skipped, {failed} failed")
+
+def write_profile_report(path, results, options, seconds):
+    """Write the per-chapter profiles of a run as JSON, for tracking build times over time."""
+    report = {
+        'generated': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'converter': converter_fingerprint(options),
+        'wall': seconds,
+        'chapters': [result['profile'] for result in results if 'profile' in result],
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote profile report to {path}")
+
+def print_build_plan(dirty, clean):
+    """Print the chapters a build would redo, for --dry-run."""
+    for tex_file, _, reason in dirty:
+        print(f"would rebuild {tex_file}: {reason}")
+    for tex_file, _ in clean:
+        print(f"up to date   {tex_file}")
+
+def watch_chapters(paths, output_root, options, jobs=None, search_index=None):
+    """Convert chapters, then reconvert each in this process whenever it or one of its inputs changes."""
+    tex_files = collect_chapters(paths)
+    results = convert_batch(tex_files, output_root, options, jobs, search_index=search_index)
+    print_batch_summary(results)
+
+    manifest = BuildManifest(os.path.join(output_root, MANIFEST_NAME))
+    fingerprint = converter_fingerprint(options)
+    chapter_dirs = set(os.path.abspath(path) for path in paths if os.path.isdir(path))
+    dependencies = {}
+
+    def track(tex_file):
+        dependencies[os.path.abspath(tex_file)] = set(
+            os.path.abspath(path) for path in [tex_file] + find_chapter_inputs(tex_file))
+
+    for tex_file in tex_files:
+        track(tex_file)
+
+    roots = chapter_dirs | set(os.path.dirname(os.path.abspath(path)) for path in paths
+                               if not os.path.isdir(path))
+    figures_dir = os.path.join(PROJECT_ROOT, 'public', 'figures')
+    if os.path.isdir(figures_dir):
+        roots.add(figures_dir)
+    watcher = ChangeWatcher(sorted(roots))
+    print(f"Watching {len(dependencies)} chapters for changes (Ctrl-C to stop)")
+    try:
+        while True:
+            changed = watcher.wait()
+            for path in changed:
+                if (path.endswith('.tex') and os.path.dirname(path) in chapter_dirs
+                        and path not in dependencies and os.path.isfile(path)):
+                    track(path)
+            everything = bool(changed & roots)
+            for tex_file, inputs in sorted(dependencies.items()):
+                if not (everything or inputs & changed) or not os.path.isfile(tex_file):
+                    continue
+                chapter_name = os.path.splitext(os.path.basename(tex_file))[0]
+                output_dir = os.path.join(output_root, chapter_name)
+                result = convert_chapter(tex_file, output_dir, options)
+                if result['ok']:
+                    manifest.record(tex_file, output_dir, fingerprint)
+                    manifest.save()
+                    if search_index:
+                        update_search_index(search_index, [(chapter_name, output_dir)])
+                track(tex_file)
+                status = 'ok' if result['ok'] else 'failed'
+                print(f"[{status}] {chapter_name} ({result['seconds'] * 1000:.0f} ms)")
+    except KeyboardInterrupt:
+        pass
     finally:
-        # Clean up environment variable
-        if 'CURRENT_CHAPTER_NAME' in os.environ:
-            del os.environ['CURRENT_CHAPTER_NAME']
+        watcher.close()
+    return 0
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python covert_tex_to_md.py <input_tex_file> <output_directory>")
-        sys.exit(1)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert LaTeX chapters to MDX.")
+    parser.add_argument('paths', nargs='*',
+                        help="<input_tex_file> <output_directory>, or with --batch, "
+                             "chapter .tex files and directories of chapters")
+    parser.add_argument('--batch', action='store_true',
+                        help="convert many chapters in parallel into --output-root")
+    parser.add_argument('--output-root', default=DEFAULT_OUTPUT_ROOT,
+                        help="directory receiving one <chapter>/index.mdx per chapter in batch mode")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of chapters converted in parallel in batch mode (default: CPU count)")
+    parser.add_argument('--force', action='store_true',
+                        help="rebuild chapters even if the build manifest says they are up to date")
+    parser.add_argument('--watch', action='store_true',
+                        help="convert the chapters as in --batch, then keep reconverting the ones that change")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="list the chapters that would be rebuilt and exit")
+    parser.add_argument('--tikz-cache-dir', default=TIKZ_CACHE_DIR,
+                        help="directory of the persistent TikZ render cache")
+    parser.add_argument('--tikz-cache-max-mb', type=float, default=None,
+                        help="evict least recently used renders beyond this size")
+    parser.add_argument('--no-tikz-cache', action='store_true',
+                        help="always re-render TikZ diagrams")
+    parser.add_argument('--tikz-jobs', type=int, default=os.cpu_count() or 1,
+                        help="number of TikZ diagrams to render concurrently; in batch mode, shared by the "
+                             "chapters converted at once")
+    parser.add_argument('--tikz-batch', action='store_true',
+                        help="compile a chapter's TikZ diagrams as pages of one pdflatex document")
+    parser.add_argument('--tikz-format', choices=['png', 'svg'], default='png',
+                        help="image format for rendered TikZ diagrams")
+    parser.add_argument('--tikz-svg-fonts', choices=['paths', 'woff2'], default='paths',
+                        help="convert glyphs to paths or embed fonts in SVG output")
+    parser.add_argument('--prune-tikz-cache', action='store_true',
+                        help="prune the TikZ cache to --tikz-cache-max-mb (default: empty it) and exit")
+    parser.add_argument('--split-sections', action='store_true',
+                        help="run pandoc on each top-level section separately and stream the MDX")
+    parser.add_argument('--section-jobs', type=int, default=os.cpu_count() or 1,
+                        help="number of sections converted concurrently with --split-sections; in batch mode, shared by the "
+                             "chapters converted at once")
+    parser.add_argument('--section-cache-dir', default=SECTION_CACHE_DIR,
+                        help="directory of the persistent per-section pandoc cache")
+    parser.add_argument('--no-section-cache', action='store_true',
+                        help="always run pandoc on every section")
+    parser.add_argument('--no-image-variants', action='store_true',
+                        help="keep plain image links instead of responsive <picture> markup")
+    parser.add_argument('--image-jobs', type=int, default=os.cpu_count() or 1,
+                        help="number of image variants encoded concurrently; in batch mode, shared by the "
+                             "chapters converted at once")
+    parser.add_argument('--image-cache-dir', default=IMAGE_CACHE_DIR,
+                        help="directory of the persistent image variant cache")
+    parser.add_argument('--no-image-cache', action='store_true',
+                        help="always re-encode missing image variants")
+    parser.add_argument('--prerender-math', action='store_true',
+                        help="typeset math with KaTeX at build time instead of in the browser")
+    parser.add_argument('--math-cache-dir', default=MATH_CACHE_DIR,
+                        help="directory of the persistent KaTeX render cache")
+    parser.add_argument('--no-math-cache', action='store_true',
+                        help="always render math with KaTeX")
+    parser.add_argument('--search-index-dir', default=SEARCH_INDEX_DIR,
+                        help="directory of the site's sharded search index")
+    parser.add_argument('--no-search-index', action='store_true',
+                        help="do not update the search index")
+    parser.add_argument('--gc-figures', action='store_true',
+                        help="delete the entries of public/figures/shared no chapter uses anymore and exit; "
+                             "with --dry-run, only list them")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="write per-stage and per-diagram timings, sizes and subprocess counts as JSON")
+    parser.add_argument('--cprofile', metavar='DIR',
+                        help="run each chapter under cProfile and dump the stats to DIR/<chapter>.prof")
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+
+    max_bytes = int(args.tikz_cache_max_mb * 1024 * 1024) if args.tikz_cache_max_mb is not None else None
+    tikz_cache = None if args.no_tikz_cache else TikzRenderCache(args.tikz_cache_dir, max_bytes)
+
+    tikz_settings = TIKZ_RENDER_SETTINGS
+    if args.tikz_format == 'svg':
+        tikz_settings = dict(TIKZ_SVG_SETTINGS, fonts=args.tikz_svg_fonts)
+
+    if args.prune_tikz_cache:
+        removed, reclaimed = TikzRenderCache(args.tikz_cache_dir).prune(max_bytes or 0)
+        print(f"Pruned {removed} TikZ renders ({reclaimed} bytes)")
+        return 0
 
-    tex_file = sys.argv[1]
-    output_dir = sys.argv[2]
-    convert_tex_to_mdx(tex_file, output_dir)
\ No newline at end of file
+    options = {
+        'tikz_cache': tikz_cache,
+        'tikz_workers': args.tikz_jobs,
+        'tikz_batch': args.tikz_batch,
+        'tikz_settings': tikz_settings,
+        'split_sections': args.split_sections,
+        'section_workers': args.section_jobs,
+        'section_cache': None if args.no_section_cache else SectionCache(args.section_cache_dir),
+        'image_variants': not args.no_image_variants,
+        'image_workers': args.image_jobs,
+        'image_cache': None if args.no_image_cache else ImageVariantCache(args.image_cache_dir),
+        'prerender_math': args.prerender_math,
+        'math_cache': None if args.no_math_cache else MathRenderCache(args.math_cache_dir),
+    }
+
+    if args.gc_figures:
+        mdx_files = glob.glob(os.path.join(PROJECT_ROOT, 'contents', 'docs', '**', '*.mdx'), recursive=True)
+        mdx_files += glob.glob(os.path.join(args.output_root, '*', 'index.mdx'))
+        removed, reclaimed = collect_figures(sorted(set(mdx_files)), args.dry_run)
+        for path in removed:
+            print(f"{'Would remove' if args.dry_run else 'Removed'} {os.path.relpath(path, PROJECT_ROOT)}")
+        print(f"{len(removed)} unreferenced figures, {reclaimed} bytes "
+              f"{'reclaimable' if args.dry_run else 'reclaimed'}")
+        return 0
+
+    search_index = None if args.no_search_index else SearchIndex(args.search_index_dir)
+
+    if args.watch:
+        return watch_chapters(args.paths or [os.path.join(PROJECT_ROOT, 'chapters')], args.output_root,
+                              options, args.jobs, search_index)
+
+    if args.batch:
+        tex_files = collect_chapters(args.paths or [os.path.join(PROJECT_ROOT, 'chapters')])
+        if not tex_files:
+            print("No .tex files found")
+            return 1
+        if args.dry_run:
+            chapters = [(tex_file, os.path.join(args.output_root, os.path.splitext(os.path.basename(tex_file))[0]))
+                        for tex_file in tex_files]
+            manifest = BuildManifest(os.path.join(args.output_root, MANIFEST_NAME))
+            print_build_plan(*plan_builds(chapters, manifest, converter_fingerprint(options), args.force))
+            return 0
+        results = convert_batch(tex_files, args.output_root, options, args.jobs, args.force,
+                                bool(args.profile), args.cprofile, search_index)
+        print_batch_summary(results)
+        if args.profile:
+            write_profile_report(args.profile, results, options, time.perf_counter() - start)
+        return 0 if all(result['ok'] for result in results) else 1
+
+    if len(args.paths) != 2:
+        parser.print_usage()
+        return 1
+
+    tex_file, output_dir = args.paths
+    manifest = BuildManifest(os.path.join(os.path.dirname(os.path.abspath(output_dir)), MANIFEST_NAME))
+    fingerprint = converter_fingerprint(options)
+    dirty, clean = plan_builds([(tex_file, output_dir)], manifest, fingerprint, args.force)
+    if args.dry_run:
+        print_build_plan(dirty, clean)
+        return 0
+    if clean:
+        print(f"{tex_file} is up to date, skipping (use --force to rebuild)")
+        return 0
+    result = convert_chapter(tex_file, output_dir, options, bool(args.profile), args.cprofile)
+    if args.profile:
+        write_profile_report(args.profile, [result], options, time.perf_counter() - start)
+    if not result['ok']:
+        return 1
+    manifest.record(tex_file, output_dir, fingerprint)
+    manifest.save()
+    if search_index:
+        update_search_index(search_index, [(result['chapter'], output_dir)])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,26 @@
+// Render TeX with KaTeX for convert_tex_to_md.py --prerender-math.
+// Reads one JSON request per line on stdin, {"tex": ..., "display": bool},
+// and answers each with one JSON line, {"html": ...} or {"error": ...}.
+// The first line written is {"version": ...}, the KaTeX version.
+const readline = require('readline');
+const katex = require('katex');
+
+process.stdout.write(JSON.stringify({ version: katex.version }) + '\n');
+
+const lines = readline.createInterface({ input: process.stdin, terminal: false });
+lines.on('line', (line) => {
+  const { tex, display } = JSON.parse(line);
+  let reply;
+  try {
+    reply = {
+      html: katex.renderToString(tex, {
+        displayMode: display,
+        throwOnError: true,
+        output: 'htmlAndMathml',
+      }),
+    };
+  } catch (error) {
+    reply = { error: String(error.message || error) };
+  }
+  process.stdout.write(JSON.stringify(reply) + '\n');
+});
@@ -0,0 +1,88 @@
+"""Patterns and helpers for reading the markdown and MDX the converter writes."""
+import html
+import json
+import re
+
+# Sidecar written next to each index.mdx
+META_NAME = 'meta.json'
+
+_MDX_HEADING_RE = re.compile(r'^(#{1,6})\s(.+)$')
+
+# Pandoc's fenced div lines, e.g. `::: marginfigure`
+_FENCED_DIV_RE = re.compile(r'^:::.*$', re.MULTILINE)
+
+# Markdown images with their attributes, and HTML image tags, in pandoc's output
+_IMAGE_REFERENCE_RE = re.compile(r'!\[(?P<alt>(?:[^\]\\]|\\.)*)\]\((?P<path>[^)\s]+)\)(?P<attrs>\{[^}]*\})?'
+                                 r'|(?P<tag><img\b[^>]*>)')
+
+# A pre-rendered equation in the MDX, as written by MathPrerender.restore
+_PRERENDERED_MATH_RE = re.compile(r'<span className="math math-(inline|display)" '
+                                  r'dangerouslySetInnerHTML=\{\{__html: ("(?:[^"\\]|\\.)*")\}\} />')
+
+# Span patterns used to tokenize pandoc's markdown, from the outermost level in
+_CODE_SPAN_RE = re.compile(r'```[\s\S]*?```')
+_TABLE_SPAN_RE = re.compile(r'::: center\n(.*?)\n:::', re.DOTALL)
+_TAG_SPAN_RE = re.compile(r'<\w+[^>]*>')
+_IMAGE_SPAN_RE = re.compile(r'!\[.*?\]\([^)]*\)(?:\\{0,2}\{[^}]*\})?')
+# The lookbehind sits after the first `$` so the scan can skip ahead to it
+_MATH_SPAN_RE = re.compile(r'\$(?<!\\\$)(?:\$[\s\S]*?(?<!\\)\$\$|[^$\n]+?(?<!\\)\$)')
+
+def tokenize_markdown(md_content):
+    """Split pandoc markdown into code, table, tag, image, math and text spans that join back to it."""
+    spans = []
+
+    def split(text, pattern, kind, inner):
+        last_end = 0
+        for match in pattern.finditer(text):
+            if match.start() > last_end:
+                inner(text[last_end:match.start()])
+            spans.append((kind, match.group(0)))
+            last_end = match.end()
+        if last_end < len(text):
+            inner(text[last_end:])
+
+    def text_spans(text):
+        spans.append(('text', text))
+
+    def math_spans(text):
+        split(text, _MATH_SPAN_RE, 'math', text_spans)
+
+    def image_spans(text):
+        split(text, _IMAGE_SPAN_RE, 'image', math_spans)
+
+    def tag_spans(text):
+        split(text, _TAG_SPAN_RE, 'tag', image_spans)
+
+    def table_spans(text):
+        split(text, _TABLE_SPAN_RE, 'table', tag_spans)
+
+    split(md_content, _CODE_SPAN_RE, 'code', table_spans)
+    return spans
+
+def sluggify(text):
+    """Heading anchor, by the same rules as sluggify in lib/markdown.ts."""
+    slug = re.sub(r'\s+', '-', text.lower())
+    return re.sub(r'[^a-z0-9-]', '', slug)
+
+def _plain_math(match):
+    # Back to the TeX KaTeX keeps in its MathML annotation
+    tex = re.search(r'<annotation encoding="application/x-tex">(.*?)</annotation>',
+                    json.loads(match.group(2)), re.DOTALL)
+    if not tex:
+        return ''
+    delimiter = '$$' if match.group(1) == 'display' else '$'
+    return f'{delimiter}{html.unescape(tex.group(1))}{delimiter}'
+
+def mdx_sections(mdx_content):
+    """Split MDX into (level, heading, body) at headings outside code; level 0 comes first."""
+    sections = [(0, None, [])]
+    in_code = False
+    for line in mdx_content.split('\n'):
+        if line.startswith('```'):
+            in_code = not in_code
+        match = None if in_code else _MDX_HEADING_RE.match(line)
+        if match:
+            sections.append((len(match.group(1)), match.group(2), []))
+        else:
+            sections[-1][2].append(line)
+    return [(level, text, '\n'.join(body)) for level, text, body in sections]
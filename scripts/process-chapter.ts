@@ -18,6 +18,24 @@ interface ProcessChapterOptions {
   title: string;
 }
 
+/**
+ * The chapter title the converter wrote to meta.json, or one made from the file name
+ */
+function chapterTitle(outputDir: string, chapterName: string): string {
+  try {
+    const meta = JSON.parse(fs.readFileSync(path.join(outputDir, 'meta.json'), 'utf-8'));
+    if (meta.title && meta.title !== 'Untitled') {
+      return meta.title;
+    }
+  } catch (error) {
+    // Not converted by a converter that writes meta.json
+  }
+  return chapterName
+    .split('_')
+    .map((word: string) => word.charAt(0).toUpperCase() + word.slice(1))
+    .join(' ');
+}
+
 async function updateRoutesConfig(title: string, href: string) {
   // Find or create the Chapters route
   let chaptersRoute = ROUTES.find((route: EachRoute) => route.title === "Chapters");
@@ -34,18 +52,22 @@ async function updateRoutesConfig(title: string, href: string) {
   if (!chaptersRoute.items) {
     chaptersRoute.items = [];
   }
-  // Add new chapter if it doesn't exist
-  const chapterExists = chaptersRoute.items.some((item: EachRoute) => item.href === href);
-  if (!chapterExists) {
-    chaptersRoute.items.push({
-      title,
-      href,
-    });
+  // Add new chapter if it doesn't exist, or retitle it if its title changed
+  const existing = chaptersRoute.items.find((item: EachRoute) => item.href === href);
+  if (!existing || existing.title !== title) {
+    if (existing) {
+      existing.title = title;
+    } else {
+      chaptersRoute.items.push({
+        title,
+        href,
+      });
+    }
     // Sort chapters alphabetically by title
     chaptersRoute.items.sort((a: EachRoute, b: EachRoute) => {
       // Keep Introduction always first
-      if (a.title === "Introduction") return -1;
-      if (b.title === "Introduction") return 1;
+      if (a.href === "/introduction") return -1;
+      if (b.href === "/introduction") return 1;
       return a.title.localeCompare(b.title);
     });
     // Generate the updated routes file content
@@ -136,25 +158,42 @@ async function processAllChapters(chaptersDir: string) {
     
     console.log(`Found ${texFiles.length} .tex files to process`);
     
-    // Process each file
+    // Convert every chapter in one Python invocation; the converter runs them
+    // in parallel and prints a "[ok] <chapter>" / "[failed] <chapter>" line each
+    const outputRoot = path.join(process.cwd(), 'contents', 'docs', 'chapters');
+    let output: string;
+    try {
+      const { stdout } = await execAsync(
+        `python3 scripts/convert_tex_to_md.py --batch "${chaptersDir}" --output-root "${outputRoot}"`
+      );
+      output = stdout;
+    } catch (error: any) {
+      // A non-zero exit means at least one chapter failed; the others are still usable
+      output = error.stdout || '';
+      console.error(error.stderr || error);
+    }
+    console.log(output);
+    
+    const statuses = new Map<string, boolean>();
+    for (const match of output.matchAll(/^\[(ok|failed)\] (\S+)/gm)) {
+      statuses.set(match[2], match[1] === 'ok');
+    }
+    
+    // Update routes for each converted chapter
     let successCount = 0;
     let failCount = 0;
     
     for (const file of texFiles) {
-      const texFile = path.join(chaptersDir, file);
-      const title = path.basename(file, '.tex')
-        .split('_')
-        .map((word: string) => word.charAt(0).toUpperCase() + word.slice(1))
-        .join(' ');
-      
-      console.log(`\nProcessing ${file} with title "${title}"...`);
-      
-      const success = await processChapter({ texFile, title });
-      if (success) {
-        successCount++;
-      } else {
+      const chapterName = path.basename(file, '.tex');
+      if (!statuses.get(chapterName)) {
         failCount++;
+        continue;
       }
+      const title = chapterTitle(path.join(outputRoot, chapterName), chapterName);
+      
+      console.log(`Updating routes for ${file} with title "${title}"...`);
+      await updateRoutesConfig(title, `/${chapterName}`);
+      successCount++;
     }
     
     console.log(`\nProcessing complete!`);
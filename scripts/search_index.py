@@ -0,0 +1,168 @@
+"""Incremental search index of the converted chapters, served with the site."""
+import gzip
+import json
+import os
+import re
+
+from build_cache import PROJECT_ROOT, atomic_write, file_hash
+from mdx_text import (META_NAME, _FENCED_DIV_RE, _IMAGE_REFERENCE_RE, _MATH_SPAN_RE, _PRERENDERED_MATH_RE,
+                      _plain_math, mdx_sections, sluggify, tokenize_markdown)
+
+# Default location of the site's search index, served with the static files
+SEARCH_INDEX_DIR = os.path.join(PROJECT_ROOT, 'public', 'search')
+
+# Terms are sharded by their first characters, so a query fetches one
+# shard per word; a heading counts as this many occurrences of its terms
+SEARCH_PREFIX_LENGTH = 2
+SEARCH_HEADING_WEIGHT = 5
+
+_SEARCH_TERM_RE = re.compile(r'[^\W_]+')
+_LINK_TARGET_RE = re.compile(r'\]\([^)\s]*\)')
+
+def search_terms(text):
+    """Lowercased runs of letters and digits; lib/search.ts splits queries the same way."""
+    return [term for term in _SEARCH_TERM_RE.findall(text.lower()) if 2 <= len(term) <= 40]
+
+def search_shard(term):
+    """Name of the shard holding a term: its prefix, hex-encoded unless plain ASCII."""
+    prefix = term[:SEARCH_PREFIX_LENGTH]
+    return prefix if prefix.isascii() else prefix.encode('utf-8').hex()
+
+def _searchable_text(body):
+    # Prose, tables and alt texts of MDX, without code, math, markup or link targets
+    parts = []
+    for kind, text in tokenize_markdown(_PRERENDERED_MATH_RE.sub(' ', body)):
+        if kind in ('text', 'table'):
+            parts.append(_LINK_TARGET_RE.sub(']', _FENCED_DIV_RE.sub('', text)))
+        elif kind == 'image':
+            match = _IMAGE_REFERENCE_RE.match(text)
+            if match:
+                parts.append(match.group('alt'))
+    return ' '.join(parts)
+
+def search_postings(mdx_content):
+    """Index a chapter as [heading, slug] sections and a map of terms to flat [section, weight, ...] lists."""
+    sections = []
+    postings = {}
+    for number, (_, heading, body) in enumerate(mdx_sections(mdx_content)):
+        weights = {}
+        if heading is None:
+            sections.append(['', ''])
+        else:
+            text = _PRERENDERED_MATH_RE.sub(_plain_math, heading).strip()
+            sections.append([text, sluggify(text)])
+            for term in search_terms(_MATH_SPAN_RE.sub(' ', text)):
+                weights[term] = weights.get(term, 0) + SEARCH_HEADING_WEIGHT
+        for term in search_terms(_searchable_text(body)):
+            weights[term] = weights.get(term, 0) + 1
+        for term, weight in weights.items():
+            postings.setdefault(term, []).extend((number, weight))
+    return sections, postings
+
+class SearchIndex:
+    """Inverted index of the chapters: manifest.json plus one gzipped JSON shard per term prefix."""
+
+    def __init__(self, index_dir=SEARCH_INDEX_DIR):
+        self.index_dir = index_dir
+        self.chapters = {}
+        manifest_path = os.path.join(index_dir, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('prefix_length') == SEARCH_PREFIX_LENGTH:
+                self.chapters = manifest['chapters']
+
+    def _shard_path(self, shard):
+        return os.path.join(self.index_dir, f'{shard}.json.gz')
+
+    def _read_shard(self, shard):
+        path = self._shard_path(shard)
+        if not os.path.exists(path):
+            return {}
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_shard(self, shard, terms):
+        path = self._shard_path(shard)
+        if not terms:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        data = json.dumps(terms, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        # mtime=0 keeps unchanged shards byte-identical across builds
+        with atomic_write(path, 'wb') as f:
+            f.write(gzip.compress(data.encode('utf-8'), 9, mtime=0))
+
+    @staticmethod
+    def _page(output_dir):
+        docs_root = os.path.join(PROJECT_ROOT, 'contents', 'docs')
+        relative = os.path.relpath(os.path.abspath(output_dir), docs_root)
+        if relative.startswith('..'):
+            relative = f'chapters/{os.path.basename(os.path.abspath(output_dir))}'
+        return f"/docs/{relative.replace(os.sep, '/')}"
+
+    def update(self, chapters):
+        """Re-index changed (chapter name, output directory) pairs; returns chapters indexed and shards written."""
+        changed = {}
+        for chapter_name, output_dir in chapters:
+            mdx_file = os.path.join(output_dir, 'index.mdx')
+            digest = file_hash(mdx_file)
+            entry = self.chapters.get(chapter_name)
+            if entry and entry['mdx'] == digest and all(
+                    os.path.exists(self._shard_path(shard)) for shard in entry['shards']):
+                continue
+            if digest is None:
+                if entry:
+                    changed[chapter_name] = (None, {})
+                continue
+            with open(mdx_file, 'r') as f:
+                mdx_content = f.read()
+            meta_file = os.path.join(output_dir, META_NAME)
+            title = chapter_name
+            if os.path.exists(meta_file):
+                with open(meta_file, 'r') as f:
+                    title = json.load(f).get('title', chapter_name)
+            sections, postings = search_postings(mdx_content)
+            changed[chapter_name] = ({'title': title, 'href': self._page(output_dir), 'sections': sections,
+                                      'mdx': digest}, postings)
+        if not changed:
+            return 0, 0
+
+        # Group the new postings by shard, and find every shard to rewrite
+        updates = {}
+        for chapter_name, (entry, postings) in changed.items():
+            old_entry = self.chapters.get(chapter_name)
+            for shard in old_entry['shards'] if old_entry else ():
+                updates.setdefault(shard, {})
+            for term, term_postings in postings.items():
+                updates.setdefault(search_shard(term), {}).setdefault(term, {})[chapter_name] = term_postings
+            if entry is None:
+                self.chapters.pop(chapter_name, None)
+            else:
+                entry['shards'] = sorted(set(search_shard(term) for term in postings))
+                self.chapters[chapter_name] = entry
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        written = 0
+        for shard, new_terms in updates.items():
+            old_terms = self._read_shard(shard)
+            terms = {}
+            for term, term_chapters in old_terms.items():
+                kept = {name: postings for name, postings in term_chapters.items() if name not in changed}
+                if kept:
+                    terms[term] = kept
+            for term, term_postings in new_terms.items():
+                terms.setdefault(term, {}).update(term_postings)
+            # Most shards a chapter touches are unaffected by a small edit
+            if terms != old_terms or not os.path.exists(self._shard_path(shard)):
+                self._write_shard(shard, terms)
+                written += 1
+        self.save()
+        return sum(1 for entry, _ in changed.values() if entry), written
+
+    def save(self):
+        manifest_path = os.path.join(self.index_dir, 'manifest.json')
+        with atomic_write(manifest_path) as f:
+            json.dump({'prefix_length': SEARCH_PREFIX_LENGTH, 'chapters': self.chapters}, f,
+                      sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+            f.write('\n')
@@ -0,0 +1,34 @@
+"""ChapterMetadata fed in pieces must describe the MDX as chapter_metadata does for it whole."""
+import os
+import random
+import sys
+
+import pytest
+
+pytest.importorskip('pypandoc')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import convert_tex_to_md as converter  # noqa: E402
+
+
+MDX = (
+    '# Introduction\n\nSome words, and $x$ math.\n\n'
+    '```\ncode with a blank line\n\n# not a heading\n```\n\n'
+    '## Setup\n\n| Property | Definition |\n|-------------|---------------|\n| Sum | $a + b$ |\n\n'
+    '::: center\nkept words\n\nacross a blank line\n:::\n\n'
+    '<img src="/figures/ch/a.png" alt="A" width="10" height="5" loading="lazy" />\n\n'
+    'Words $i<j$ before\n\nand $a>b$ after.\n\n'
+    '![b](/figures/shared/0123456789abcdef-320.webp)\n\n### Deeper\n\nEnd.\n'
+)
+
+@pytest.mark.parametrize('seed', range(10))
+def test_pieces_match_whole(seed):
+    rng = random.Random(seed)
+    metadata = converter.ChapterMetadata('T', 'hash')
+    start = 0
+    while start < len(MDX):
+        end = start + rng.randint(1, 12)
+        metadata.feed(MDX[start:end])
+        start = end
+    assert metadata.metadata() == converter.chapter_metadata(MDX, 'T', 'hash')
+    assert metadata.assets() == converter.mdx_assets(MDX)
+    assert metadata.size == len(MDX.encode('utf-8'))
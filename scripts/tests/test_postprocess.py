@@ -0,0 +1,173 @@
+"""Pin postprocess_markdown to the chain of whole-document passes it replaced.
+
+The old passes are reconstructed below as the baseline converter ran them
+after pandoc, minus handle_images, which only rewrote \\includegraphics and
+so never matched pandoc's markdown. The chapter name ensure_image_paths
+read from CURRENT_CHAPTER_NAME is passed as an argument instead.
+"""
+import glob
+import os
+import re
+import sys
+
+import pytest
+
+pytest.importorskip('pypandoc')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import convert_tex_to_md as converter  # noqa: E402
+
+
+def escape_braces(content):
+    content = re.sub(r'(?<!\\)\{', '\\{', content)
+    content = re.sub(r'(?<!\\)\}', '\\}', content)
+    return content
+
+def remove_language_references(content):
+    return re.sub(r'``` \{\.([a-zA-Z]+)\s+language="[^"]+"\}', '```', content)
+
+def clean_code_blocks(content):
+    def clean_block(match):
+        code = match.group(1).strip()
+        code = re.sub(r'\{\.([a-zA-Z]+)\s+language="[^"]+"\}', '', code)
+        return f'```\n{code}\n```'
+    return re.sub(r'```([\s\S]*?)```', clean_block, content)
+
+def fix_math_delimiters(content):
+    return re.sub(r'\\\((.*?)\\\)', r'$\1$', content)
+
+def fix_set_notation(content):
+    content = re.sub(r'\\\\{\\\\}', '\\{\\}', content)
+    content = re.sub(r'\\\\{([^}]*)\\\\}', '\\{\\1\\}', content)
+    return content
+
+def format_tables(content):
+    def format_table(match):
+        lines = [line.strip() for line in match.group(1).split('\n') if line.strip()]
+        formatted_lines = []
+        for line in lines:
+            if '----' in line:
+                continue
+            parts = line.split('$', 2)
+            if len(parts) >= 2:
+                formatted_lines.append(f'| {parts[0].strip()} | {"$" + "$".join(parts[1:])} |')
+        return "| Property | Definition |\n|-------------|---------------|\n" + '\n'.join(formatted_lines)
+    return re.sub(r'::: center\n(.*?)\n:::', format_table, content, flags=re.DOTALL)
+
+# The old heading fix-up, and the one postprocess_markdown has, which stays on the heading's line
+LEGACY_HEADING_RE = r'#\s+([^\\]+)\\'
+HEADING_RE = r'#[^\S\n]+([^\\\n]+)\\'
+
+def remove_labels(content, heading_re=LEGACY_HEADING_RE):
+    content = re.sub(r'\\label\{[^}]*\}', '', content)
+    content = re.sub(r'\{#[^}]*\}', '', content)
+    content = re.sub(r'\{reference-type="[^"]*"\s+reference="[^"]*"\}', '', content)
+    content = re.sub(r'\[\[.*?\]\]\(#.*?\)', '', content)
+    content = re.sub(heading_re, r'# \1', content)
+    content = re.sub(r'\[\]\s*\n', '\n', content)
+    content = re.sub(r'Table \[\[.*?\]\]', 'Table', content)
+    content = re.sub(r'\(#.*?\)', '', content)
+    content = re.sub(r'\[\[.*?\]\]', '', content)
+    content = re.sub(r'\n\s*\n\s*\n', '\n\n', content)
+    return content
+
+def ensure_image_paths(content, chapter_name):
+    content = re.sub(r'<img src="(?!\/|http)([^"]+)"', r'<img src="/\1"', content)
+    content = re.sub(r'!\[(.*?)\]\((?!\/|http)([^)]+)\)', r'![\1](/\2)', content)
+    content = re.sub(r'!\[(.*?)\]\((?!\/|http)([^)]+)\)(\{[^}]*\})', r'![\1](/\2)\3', content)
+    if chapter_name:
+        def fix_paths(match):
+            # A missing group gives None, written out as "None" as the old pass did
+            alt_text, path = match.group(1), match.group(2)
+            attrs = match.group(3) if len(match.groups()) > 2 else ''
+            if re.match(r'^/figures/[^/]+/', path):
+                return f'![{alt_text}]({path}){attrs}'
+            return f'![{alt_text}](/figures/{chapter_name}/{os.path.basename(path)}){attrs}'
+        content = re.sub(r'!\[(.*?)\]\(([^)]+)\)(\{[^}]*\})?', fix_paths, content)
+        content = re.sub(r'!\[(.*?)\]\(figures/part1b/[^)]+/([^/)]+)\)(\{[^}]*\})?',
+                         lambda m: f'![{m.group(1)}](/figures/{chapter_name}/{m.group(2)}){m.group(3) or ""}',
+                         content)
+    content = re.sub(r'src="//+', r'src="/', content)
+    content = re.sub(r'\]\(//+', r'](/', content)
+    return content
+
+def remove_inline_styles(content):
+    content = re.sub(r'<img([^>]*)style=\{[^}]*\}([^>]*)>', r'<img\1\2>', content)
+    content = re.sub(r'<img([^>]*)style\s*=\s*\{[^}]*\}([^>]*)>', r'<img\1\2>', content)
+    content = re.sub(r'<img([^>]*)style=\{\s*width:\s*"[^"]*"\s*\}([^>]*)>', r'<img\1\2>', content)
+    content = re.sub(r'<img([^>]*)\bstyle\s*=\s*\{\s*[^}]*\s*\}([^>]*)>', r'<img\1\2>', content)
+    content = re.sub(r'<(\w+)([^>]*)\bstyle\s*=\s*\{[^}]*\}([^>]*)>', r'<\1\2\3>', content)
+    content = re.sub(r'<(\w+)([^>]*)  +([^>]*)>', r'<\1\2 \3>', content)
+    content = re.sub(r'<(\w+)([^>]*) +>', r'<\1\2>', content)
+    content = re.sub(r'!\[(.*?)\]\((.*?)\)(\{[^}]*\})', r'![\1](\2)', content)
+    content = re.sub(r'!\[(.*?)\]\((.*?)\)(\{width="[^"]*"\})', r'![\1](\2)', content)
+    content = re.sub(r'(!\[[^\]]*\]\([^)]*\))None\{width="[^"]*"\}', r'\1', content)
+    return content
+
+def legacy_postprocess(md_content, chapter_name, heading_re=LEGACY_HEADING_RE):
+    mdx_content = escape_braces(md_content)
+    mdx_content = remove_language_references(mdx_content)
+    mdx_content = clean_code_blocks(mdx_content)
+    mdx_content = fix_set_notation(mdx_content)
+    mdx_content = fix_math_delimiters(mdx_content)
+    mdx_content = format_tables(mdx_content)
+    mdx_content = remove_labels(mdx_content, heading_re)
+    mdx_content = ensure_image_paths(mdx_content, chapter_name)
+    return remove_inline_styles(mdx_content)
+
+
+# Pandoc markdown both implementations turn into the same MDX
+FIXTURES = {
+    'headings': (
+        '# Introduction {#sec:intro}\n\n'
+        '## Minimizing $f \\colon X \\to Y$ {#sec:min}\n\n'
+        'See Section [\\[sec:intro\\]](#sec:intro){reference-type="ref" reference="sec:intro"}.\n'
+    ),
+    'heading_labels': '# Basics \\label{ch:basics}\n\nText $\\alpha$.\n\n## Next {#sec:next}\n\nMore.\n',
+    'code': (
+        'Text.\n\n``` {.python language="Python"}\n\ndef f(x):\n    return {x: 1}\n\n```\n\n'
+        'After \\(a\\).\n'
+    ),
+    'tags': '<img src="a.png" style={{width: "40%"}} />\n\n<figure>\n  <img src="/b.png" alt="B" />\n</figure>\n',
+    'braces': 'The set $\\{1, 2\\}$ and $f_{i}$ and \\\\{x\\\\} in text {b}.\n',
+    'table': (
+        '::: center\n  Property   Definition\n  ---------- ------------\n'
+        '  Sum        $a + b$\n  Empty      $\\{\\}$\n:::\n'
+    ),
+    'images': '![image](figures/part1b/ch/a.png){width="2.7in"}\n\n![b](/figures/ch/b.png)None{width="2in"}\n',
+}
+
+@pytest.mark.parametrize('name', sorted(FIXTURES))
+def test_matches_legacy(name):
+    md_content = FIXTURES[name]
+    assert converter.postprocess_markdown(md_content, 'ch') == legacy_postprocess(md_content, 'ch')
+
+def test_streamed_pieces_match_whole():
+    md_content = ''.join(FIXTURES[name] + '\n' for name in sorted(FIXTURES))
+    chunks = [FIXTURES[name] + '\n' for name in sorted(FIXTURES)]
+    streamed = ''.join(converter.iter_postprocess_markdown(chunks, 'ch'))
+    assert streamed == converter.postprocess_markdown(md_content, 'ch')
+
+def test_heading_fixup_stays_on_its_line():
+    # The old pass ate the backslash of \mathbb below a heading without one
+    md_content = '# Introduction\n\nWe work in $\\mathbb{R}^n$.\n'
+    expected = '# Introduction\n\nWe work in $\\mathbb\\{R\\}^n$.\n'
+    assert converter.postprocess_markdown(md_content, 'ch') == expected
+    assert legacy_postprocess(md_content, 'ch') == '# Introduction\n\nWe work in $mathbb\\{R\\}^n$.\n'
+
+def test_tags_in_code_blocks_are_left_alone():
+    md_content = '<img src="a.png" />\n\n```\n<img src="a.png" />\n```\n'
+    expected = '<img src="/a.png" />\n\n```\n<img src="a.png" />\n```\n'
+    assert converter.postprocess_markdown(md_content, 'ch') == expected
+    assert legacy_postprocess(md_content, 'ch') == expected.replace('"a.png"', '"/a.png"')
+
+@pytest.mark.parametrize('tex_file', sorted(glob.glob(os.path.join(converter.PROJECT_ROOT, 'chapters', '*.tex'))))
+def test_chapters_match_legacy(tex_file):
+    with open(tex_file, 'r') as f:
+        tex_content = f.read()
+    try:
+        md_content = converter.pypandoc.convert_text(tex_content, 'markdown', format='latex')
+    except OSError as e:
+        pytest.skip(f"pandoc is not available: {e}")
+    chapter_name = os.path.splitext(os.path.basename(tex_file))[0]
+    expected = legacy_postprocess(md_content, chapter_name, HEADING_RE)
+    assert converter.postprocess_markdown(md_content, chapter_name) == expected
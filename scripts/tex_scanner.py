@@ -0,0 +1,235 @@
+"""Index the environments and commands of a LaTeX source in one linear scan."""
+import re
+
+# Environments and commands recorded by scan_tex; other environments are
+# only tracked to keep the nesting straight
+TEX_INDEXED_ENVIRONMENTS = ('document', 'figure', 'figure*', 'subfigure', 'table', 'table*', 'tikzpicture')
+TEX_INDEXED_COMMANDS = ('caption', 'includegraphics', 'label',
+                        'chapter', 'section', 'subsection', 'subsubsection')
+
+# Macro definition commands, recorded as 'macro' spans, with the number of
+# arguments a definition takes after the command
+TEX_DEFINITION_ARGUMENTS = {'newcommand': 2, 'renewcommand': 2, 'providecommand': 2,
+                            'DeclareMathOperator': 2, 'newenvironment': 3, 'renewenvironment': 3,
+                            'def': None, 'gdef': None, 'edef': None, 'let': None}
+
+# Environments whose body is not LaTeX; the scanner jumps straight to their end
+TEX_VERBATIM_ENVIRONMENTS = ('verbatim', 'lstlisting', 'minted', 'comment')
+
+# Everything the scanner stops at. `\\` and `\%` are consumed so the
+# backslash or percent sign they contain is not mistaken for the start of
+# something else; a bare `%` starts a comment.
+_TEX_TOKEN_RE = re.compile(r'\\(?:(begin|end)\s*\{([^{}]*)\}|(' + '|'.join(TEX_INDEXED_COMMANDS) + r')(?![a-zA-Z@])'
+                           r'|(' + '|'.join(TEX_DEFINITION_ARGUMENTS) + r')(?![a-zA-Z@])|[\\%])|%')
+
+_TEX_CONTROL_SEQUENCE_RE = re.compile(r'\\(?:[a-zA-Z@]+|.)', re.DOTALL)
+_TEX_LET_RE = re.compile(r'\s*\\(?:[a-zA-Z@]+|.)\s*=?\s*(?:\\(?:[a-zA-Z@]+|.)|[^\\\s])', re.DOTALL)
+
+# Tokens that matter inside a command argument
+_TEX_GROUP_RE = re.compile(r'\\.|%[^\n]*|[{}\[\]]', re.DOTALL)
+
+class TexSpan:
+    """An environment or command found by scan_tex."""
+
+    def __init__(self, kind, source, start, body_start, parent):
+        self.kind = kind
+        self.source = source
+        self.start = start
+        self.body_start = body_start
+        self.body_end = None
+        self.end = None
+        self.options = None
+        self.parent = parent
+        self.children = []
+        self.environment = None
+
+    @property
+    def text(self):
+        return self.source[self.start:self.end]
+
+    @property
+    def body(self):
+        return self.source[self.body_start:self.body_end]
+
+    def find(self, kind):
+        """Indexed spans of the given kind directly inside this one."""
+        return [child for child in self.children if child.kind == kind and child.end is not None]
+
+    def first(self, kind):
+        found = self.find(kind)
+        return found[0] if found else None
+
+    def enclosing(self, kind):
+        """The nearest span of the given kind containing this one, or None."""
+        parent = self.parent
+        while parent is not None and parent.kind != kind:
+            parent = parent.parent
+        return parent
+
+class TexIndex:
+    """Environment and command spans of a LaTeX source, in source order."""
+
+    def __init__(self, source):
+        self.source = source
+        self.spans = {kind: [] for kind in TEX_INDEXED_ENVIRONMENTS + TEX_INDEXED_COMMANDS + ('macro',)}
+
+    def find(self, kind, outermost=False):
+        """All complete spans of a kind; with `outermost`, skip those nested in the same kind."""
+        return [span for span in self.spans[kind]
+                if span.end is not None and not (outermost and span.enclosing(kind))]
+
+def _tex_group(source, pos, opening):
+    """Return the position after the group opened at `pos` by `opening`, or None if it is not closed."""
+    depth = 0
+    for match in _TEX_GROUP_RE.finditer(source, pos + 1):
+        token = match.group(0)
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            if depth == 0:
+                return match.end() if opening == '{' else None
+            depth -= 1
+        elif token == ']' and opening == '[' and depth == 0:
+            return match.end()
+    return None
+
+def _tex_definition_end(source, pos, name):
+    """Find the end of a macro definition whose command ends at `pos`, or None."""
+    if name == 'let':
+        match = _TEX_LET_RE.match(source, pos)
+        return match.end() if match else None
+    if TEX_DEFINITION_ARGUMENTS[name] is None:
+        # \def\name<parameter text>{body}
+        start = source.find('{', pos)
+        return _tex_group(source, start, '{') if start >= 0 else None
+    if source.startswith('*', pos):
+        pos += 1
+    for _ in range(TEX_DEFINITION_ARGUMENTS[name]):
+        pos = _skip_spaces(source, pos)
+        while source.startswith('[', pos):
+            pos = _tex_group(source, pos, '[')
+            if pos is None:
+                return None
+            pos = _skip_spaces(source, pos)
+        if source.startswith('{', pos):
+            pos = _tex_group(source, pos, '{')
+            if pos is None:
+                return None
+        else:
+            match = _TEX_CONTROL_SEQUENCE_RE.match(source, pos)
+            if not match:
+                return None
+            pos = match.end()
+    return pos
+
+def _skip_spaces(source, pos):
+    while pos < len(source) and source[pos] in ' \t\n':
+        pos += 1
+    return pos
+
+def scan_tex(source):
+    """Index the environments, commands and macro definitions of a source in one linear scan."""
+    index = TexIndex(source)
+    stack = []          # (environment name, TexSpan or None) of open environments
+    parent = None       # innermost open indexed span
+    pos = 0
+    while True:
+        match = _TEX_TOKEN_RE.search(source, pos)
+        if not match:
+            break
+        pos = match.end()
+        token = match.group(0)
+
+        if token == '%':
+            newline = source.find('\n', pos)
+            if newline < 0:
+                break
+            pos = newline + 1
+
+        elif match.group(1) == 'begin':
+            name = match.group(2).strip()
+            if name in TEX_VERBATIM_ENVIRONMENTS:
+                end_match = re.compile(r'\\end\s*\{' + re.escape(name) + r'\}').search(source, pos)
+                if not end_match:
+                    break
+                pos = end_match.end()
+                continue
+            span = None
+            if name in TEX_INDEXED_ENVIRONMENTS:
+                span = TexSpan(name, source, match.start(), pos, parent)
+                span.environment = stack[-1][0] if stack else None
+                index.spans[name].append(span)
+                if parent:
+                    parent.children.append(span)
+                parent = span
+            stack.append((name, span))
+
+        elif match.group(1) == 'end':
+            name = match.group(2).strip()
+            depth = len(stack) - 1
+            while depth >= 0 and stack[depth][0] != name:
+                depth -= 1
+            if depth < 0:
+                # Stray \end; ignore it
+                continue
+            span = stack[depth][1]
+            del stack[depth:]
+            if span:
+                span.body_end = match.start()
+                span.end = pos
+            parent = next((span for _, span in reversed(stack) if span), None)
+
+        elif match.group(4):
+            end = _tex_definition_end(source, pos, match.group(4))
+            if end is None:
+                continue
+            span = TexSpan('macro', source, match.start(), match.start(), parent)
+            span.body_end = span.end = pos = end
+            span.environment = stack[-1][0] if stack else None
+            index.spans['macro'].append(span)
+
+        elif match.group(3):
+            kind = match.group(3)
+            options = None
+            # Starred forms, such as \section*, are recorded under the same kind
+            if source.startswith('*', pos):
+                pos += 1
+            start = _skip_spaces(source, pos)
+            if source.startswith('[', start):
+                options_end = _tex_group(source, start, '[')
+                if options_end is None:
+                    continue
+                options = source[start + 1:options_end - 1]
+                start = _skip_spaces(source, options_end)
+            if not source.startswith('{', start):
+                continue
+            end = _tex_group(source, start, '{')
+            if end is None:
+                continue
+            span = TexSpan(kind, source, match.start(), start + 1, parent)
+            span.body_end = end - 1
+            span.end = end
+            span.options = options
+            span.environment = stack[-1][0] if stack else None
+            index.spans[kind].append(span)
+            if parent:
+                parent.children.append(span)
+            # The argument has been read; captions may hold further commands
+            pos = start + 1
+
+    return index
+
+def splice_spans(source, replacements):
+    """Replace (start, end, text) ranges of the source, in source order, in one pass."""
+    if not replacements:
+        return source
+    pieces = []
+    last_end = 0
+    for start, end, text in replacements:
+        if start < last_end:
+            continue
+        pieces.append(source[last_end:start])
+        pieces.append(text)
+        last_end = end
+    pieces.append(source[last_end:])
+    return ''.join(pieces)